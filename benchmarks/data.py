@@ -0,0 +1,35 @@
+import random
+from typing import Any, List
+
+from danmuku.provides.columns import DanmuColumns
+
+COLORS = ["#FFFFFF", "#ffffff", "#FE0302", "#FFFF00", "#00CD00", "#4266BE"]
+POSITIONS = ["right", "right", "right", "right", "top", "bottom"]
+SIZES = ["25px", "25px", "25px", "18px"]
+
+
+def make_danmu(
+    count: int, duration: float = 2700.0, distinct: float = 0.6, seed: int = 0
+) -> List[List[Any]]:
+    """生成按时间排序的模拟弹幕，distinct 为不重复文本所占比例"""
+    rng = random.Random(seed)
+    texts = max(int(count * distinct), 1)
+    danmu = [
+        [
+            round(rng.uniform(0, duration), 1),
+            rng.choice(POSITIONS),
+            rng.choice(COLORS),
+            rng.choice(SIZES),
+            f"弹幕内容{rng.randrange(texts)}",
+        ]
+        for _ in range(count)
+    ]
+    danmu.sort(key=lambda x: x[0])
+    return danmu
+
+
+def make_columns(count: int, **kwargs: Any) -> DanmuColumns:
+    danmu = DanmuColumns()
+    for time, position, color, size, text in make_danmu(count, **kwargs):
+        danmu.append(time, text, color, position, size)
+    return danmu
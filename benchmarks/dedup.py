@@ -0,0 +1,108 @@
+"""对比逐条遍历和 NumPy 两种弹幕去重方式，并检查两者结果完全相同
+
+    python -m benchmarks.dedup
+
+``VECTORIZE_MIN_ROWS`` 和 ``VECTORIZE_MAX_ROWS`` 按这里不同条数下的测量结果设置。
+"""
+
+import random
+import time
+from typing import List
+
+from danmuku import functions
+from danmuku.provides.columns import DanmuColumns
+from .data import make_columns
+
+### 模拟多个平台的弹幕拼接在一起，各平台内部按时间排序
+PLATFORMS = 3
+### 测量的弹幕条数，覆盖阈值附近到一集弹幕很多的情况
+COUNTS = (300, 1_000, 3_000, 10_000, 30_000, 100_000, 300_000, 1_000_000)
+### 随机检查的次数
+FUZZ_ROUNDS = 500
+
+
+def make_runs(count: int) -> List[DanmuColumns]:
+    return [
+        make_columns(count // PLATFORMS, seed=seed, distinct=0.5)
+        for seed in range(PLATFORMS)
+    ]
+
+
+def run(func, arg, vectorize: bool) -> DanmuColumns:
+    """强制使用其中一种实现，不受阈值影响"""
+    limits = functions.VECTORIZE_MIN_ROWS, functions.VECTORIZE_MAX_ROWS
+    if vectorize:
+        functions.VECTORIZE_MIN_ROWS, functions.VECTORIZE_MAX_ROWS = 0, float("inf")
+    else:
+        functions.VECTORIZE_MIN_ROWS = float("inf")
+    try:
+        return func(arg)
+    finally:
+        functions.VECTORIZE_MIN_ROWS, functions.VECTORIZE_MAX_ROWS = limits
+
+
+def measure(func, arg, vectorize: bool, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(func, arg, vectorize)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def random_runs(rng: random.Random) -> List[DanmuColumns]:
+    """时间大量重复（包括 0.0 和 -0.0）、文本大量重复的小样本，容易暴露先后顺序的差异"""
+    runs = []
+    for _ in range(rng.randint(1, 4)):
+        danmu = DanmuColumns()
+        count = rng.randint(0, 60)
+        if rng.random() < 0.7:
+            times = sorted(
+                rng.choice([0.0, 1.0, 1.5, 2.0, rng.uniform(0, 5)])
+                for _ in range(count)
+            )
+        else:
+            times = [rng.choice([0.0, -0.0, 1.0, 2.0]) for _ in range(count)]
+        for t in times:
+            danmu.append(t, f"t{rng.randrange(15)}", rng.choice(["#FFFFFF", "#fe0302"]))
+        runs.append(danmu)
+    return runs
+
+
+def check_equivalence(rounds: int = FUZZ_ROUNDS) -> None:
+    rng = random.Random(1)
+    for _ in range(rounds):
+        runs = random_runs(rng)
+        merged = DanmuColumns.concat(runs)
+        for func, arg in (
+            (functions.deduplicate_danmu, merged),
+            (functions.merge_danmu, runs),
+        ):
+            expected = run(func, arg, vectorize=False).to_list()
+            assert run(func, arg, vectorize=True).to_list() == expected
+    print(f"随机检查 {rounds} 次：两种实现结果相同")
+
+
+def main() -> None:
+    check_equivalence()
+    for count in COUNTS:
+        runs = make_runs(count)
+        merged = DanmuColumns.concat(runs)
+        repeat = max(5, min(50, 300_000 // count))
+        for name, func, arg in (
+            ("deduplicate_danmu", functions.deduplicate_danmu, merged),
+            ("merge_danmu", functions.merge_danmu, runs),
+        ):
+            expected = run(func, arg, vectorize=False)
+            actual = run(func, arg, vectorize=True)
+            assert actual.to_list() == expected.to_list()
+            slow = measure(func, arg, False, repeat)
+            fast = measure(func, arg, True, repeat)
+            print(
+                f"{count:>9} 条 {name:<18}: 逐条 {slow * 1000:8.2f} ms  "
+                f"NumPy {fast * 1000:8.2f} ms  加速 {slow / fast:5.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
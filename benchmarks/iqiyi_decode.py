@@ -0,0 +1,99 @@
+"""测量爱奇艺分段解压和解析对事件循环的阻塞
+
+    python -m benchmarks.iqiyi_decode
+
+用本地生成的 .br 分段模拟一集长视频的下载，同时每毫秒唤醒一次的
+探测任务记录事件循环的延迟，分别比较 inline、thread 和 process 三种方式。
+"""
+
+import asyncio
+import random
+import statistics
+import time
+from typing import List
+
+import brotlicffi as brotli
+
+from danmuku.provides.executor import DecodePool
+from danmuku.provides.iqiyi import iqiyi
+from danmuku.provides.iqiyi import iqiyidm_pb2 as Iqiyidm_pb2
+
+SEGMENTS = 120
+BULLETS_PER_SEGMENT = 3000
+
+
+def make_segment(index: int, bullets: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed + index)
+    danmu = Iqiyidm_pb2.Danmu()
+    entry = danmu.entry.add()
+    for i in range(bullets):
+        item = entry.bulletInfo.add()
+        item.showTime = str(index * 60 + rng.randrange(60))
+        item.content = f"弹幕内容{rng.randrange(bullets)}"
+        item.a8 = rng.choice(["ffffff", "FE0302", "FFFF00"])
+        item.id = str(i)
+    return brotli.compress(danmu.SerializeToString())
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+
+class FakeClient:
+    """按随机的网络延迟返回预先生成的分段"""
+
+    def __init__(self, payloads: List[bytes]):
+        self.payloads = payloads
+        self.rng = random.Random(1)
+
+    async def get(self, url: str, **kwargs) -> FakeResponse:
+        await asyncio.sleep(self.rng.uniform(0.005, 0.05))
+        index = int(url.rsplit("_", 2)[-2]) - 1
+        return FakeResponse(self.payloads[index])
+
+
+async def monitor(lags: List[float], stop: asyncio.Event) -> None:
+    interval = 0.001
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run(kind: str, payloads: List[bytes]) -> None:
+    iqiyi.decode_pool = pool = DecodePool(kind=kind)
+    # 每种方式使用不同的文件名，避免命中分段缓存
+    urls = [
+        f"https://cmts.iqiyi.com/bullet/00/00/{kind}_60_{i + 1}_bench.br"
+        for i in range(len(payloads))
+    ]
+    client = FakeClient(payloads)
+    lags: List[float] = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(monitor(lags, stop))
+    start = time.perf_counter()
+    danmu = await iqiyi.read_barrage(urls, client=client)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+    pool.shutdown()
+    lags.sort()
+    print(
+        f"{kind:>8}: 总耗时 {elapsed * 1000:7.1f} ms  {len(danmu)} 条  "
+        f"循环延迟 p50 {statistics.median(lags) * 1000:6.2f} ms  "
+        f"p99 {lags[int(len(lags) * 0.99)] * 1000:6.2f} ms  "
+        f"max {lags[-1] * 1000:6.2f} ms"
+    )
+
+
+async def main() -> None:
+    payloads = [make_segment(i, BULLETS_PER_SEGMENT) for i in range(SEGMENTS)]
+    for kind in ("inline", "thread", "process"):
+        await run(kind, payloads)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
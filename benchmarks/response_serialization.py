@@ -0,0 +1,59 @@
+"""对比弹幕接口的两种响应序列化方式
+
+    python -m benchmarks.response_serialization
+"""
+
+import asyncio
+import time
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+from danmuku import api
+from .data import make_columns
+
+
+def get_response_field():
+    for route in api.fastapi_app.routes:
+        if getattr(route, "path", None) == "/api/douban_id":
+            return route.secure_cloned_response_field
+    raise RuntimeError("/api/douban_id route not found")
+
+
+async def pydantic_path(field, danmu) -> bytes:
+    """默认路径：按 response_model 校验后再用 JSONResponse 编码"""
+    api.FAST_RESPONSE = False
+    content = api.danmu_response("bench", danmu)
+    value = await serialize_response(field=field, response_content=content)
+    return JSONResponse(value).body
+
+
+async def fast_path(field, danmu) -> bytes:
+    api.FAST_RESPONSE = True
+    return api.danmu_response("bench", danmu).body
+
+
+async def measure(func, field, danmu, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func(field, danmu)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+async def main() -> None:
+    field = get_response_field()
+    for count in (10_000, 100_000, 500_000):
+        danmu = make_columns(count)
+        assert await pydantic_path(field, danmu) == await fast_path(field, danmu)
+        slow = await measure(pydantic_path, field, danmu, 3)
+        fast = await measure(fast_path, field, danmu, 3)
+        print(
+            f"{count:>8} 条: pydantic {slow * 1000:8.1f} ms  "
+            f"orjson {fast * 1000:8.1f} ms  加速 {slow / fast:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+"""对比搜狐弹幕固定窗口与按时长切分窗口的请求数和覆盖范围
+
+    python -m benchmarks.souhu_windows
+
+响应按真实接口的格式由本地数据生成，不访问网络。
+"""
+
+import asyncio
+import json
+from typing import Dict, List, Tuple
+
+from danmuku.provides import souhu
+from danmuku.provides.utils import resolve_url_query
+
+### 改动前 get_link 的固定窗口：0-6000 秒，每 300 秒一个请求
+OLD_WINDOWS = [(i * 300, (i + 1) * 300) for i in range(20)]
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.encoding = "utf-8"
+        self.charset_encoding = "utf-8"
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeClient:
+    """按时间窗口返回弹幕，记录请求次数"""
+
+    def __init__(
+        self,
+        vid: str,
+        duration: int,
+        with_duration: bool = True,
+        page_duration: int = 0,
+        cap: int = 0,
+    ):
+        self.vid = vid
+        self.duration = duration
+        self.with_duration = with_duration
+        # 播放页中的时长与实际不符（例如取到了相关视频的时长）
+        self.page_duration = page_duration or duration
+        # 每次请求最多返回的条数，0 表示不限
+        self.cap = cap
+        self.requests = 0
+        # 每 5 秒一条弹幕，直到片尾
+        self.comments = [
+            {"v": t, "c": f"{vid}-{t}"} for t in range(0, duration, 5)
+        ]
+
+    async def get(self, url: str, params=None, impersonate=None) -> FakeResponse:
+        self.requests += 1
+        if url.startswith(souhu.API_DANMU):
+            query = resolve_url_query(url)
+            begin = int(query["time_begin"][0])
+            end = int(query["time_end"][0])
+            comments = [c for c in self.comments if begin <= c["v"] < end]
+            if self.cap:
+                comments = comments[: self.cap]
+            return FakeResponse(json.dumps({"info": {"comments": comments}}))
+        if url.startswith("https://pl.hd.sohu.com/videolist"):
+            return FakeResponse(json.dumps({"videos": []}))
+        page = f'var vid="{self.vid}";\nvar playlistId="1";\n'
+        if self.with_duration:
+            page += f"var duration = '{self.page_duration}';\n"
+        return FakeResponse(page)
+
+
+async def old_fetch(client: FakeClient) -> Tuple[int, int]:
+    await client.get("https://tv.sohu.com/v/page.html")
+    results = await asyncio.gather(
+        *[
+            client.get(souhu.build_window_url(client.vid, "1", begin, end))
+            for begin, end in OLD_WINDOWS
+        ]
+    )
+    count = sum(len(souhu.parse(res.json())) for res in results)
+    return client.requests, count
+
+
+async def new_fetch(client: FakeClient) -> Tuple[int, int]:
+    info = await souhu.get_video_info(client, "https://tv.sohu.com/v/page.html")
+    danmu = await souhu.read_by_info(client, info)
+    return client.requests, len(danmu)
+
+
+async def main() -> None:
+    cases: List[Dict] = [
+        {"duration": 120},
+        {"duration": 1500},
+        {"duration": 2700},
+        {"duration": 7800},
+        {"duration": 2700, "with_duration": False},
+        {"duration": 2700, "page_duration": 1500},
+        {"duration": 2700, "cap": 100},
+    ]
+    for n, case in enumerate(cases):
+        label = f"{case['duration']:>5} 秒"
+        if not case.get("with_duration", True):
+            label += "（无时长）"
+        elif case.get("page_duration"):
+            label += f"（页面时长 {case['page_duration']}）"
+        elif case.get("cap"):
+            label += f"（每次最多 {case['cap']} 条）"
+        old_requests, old_count = await old_fetch(FakeClient(f"old{n}", **case))
+        new_requests, new_count = await new_fetch(FakeClient(f"new{n}", **case))
+        total = len(FakeClient("total", case["duration"]).comments)
+        print(
+            f"{label:<20} 固定窗口 {old_requests:>3} 次请求 {old_count:>5}/{total} 条  "
+            f"按时长 {new_requests:>3} 次请求 {new_count:>5}/{total} 条"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,34 @@
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Annotated, List, Any
+from typing import Annotated, List, Any, AsyncIterator, Dict, Optional
 from urllib.parse import unquote_plus
 import httpx
 import io
+import json
+import os
+import orjson
 from .functions import (
     get_danmu_by_url,
     get_danmu_by_id,
     get_danmu_by_title,
     get_danmu_by_title_caiji,
+    get_platform_urls_by_id,
+    get_platform_urls_by_title,
+    select_episode_urls,
+    stream_platforms_danmu,
 )
+from .provides.session import session_pool_lifespan
+from .provides.executor import decode_pool_lifespan
+from .provides.limiter import host_limits
+from .provides.columns import DanmuColumns
+from .cache import cache_lifespan
+from .retry import current_stats, track_segments
+from .deadline import request_budget
+from .disconnect import cancel_on_disconnect
+from starlette.requests import ClientDisconnect
+import contextlib
 
 
 class DanmukuResponse(BaseModel):
@@ -19,6 +36,90 @@ class DanmukuResponse(BaseModel):
     name: str
     danmu: int
     danmuku: List[List[Any]]
+    # 请求时间预算用完时为 true，此时只包含已经完成的平台
+    partial: bool = False
+    # 各平台的状态（ok、empty、error、timeout）和原始弹幕条数
+    platforms: Dict[str, Dict[str, Any]] = {}
+
+
+### 开启后跳过 DanmukuResponse 的逐条校验，直接用 orjson 输出响应
+FAST_RESPONSE = os.getenv("DANMU_FAST_RESPONSE", "0") == "1"
+
+
+class DanmukuJSONResponse(Response):
+    """用 orjson 直接把弹幕结果编码为字节"""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+def danmu_response(
+    name: str,
+    danmuku: DanmuColumns,
+    platforms: Optional[Dict[str, Dict[str, Any]]] = None,
+    partial: bool = False,
+) -> Any:
+    """构造弹幕响应
+
+    返回 Response 时 FastAPI 不再按 response_model 校验和转换，
+    /docs 中的响应结构仍然来自路由上声明的 DanmukuResponse。
+    """
+    content = {
+        "code": 0,
+        "name": name,
+        "danmu": len(danmuku),
+    }
+    if FAST_RESPONSE:
+        # orjson 直接把元组编码为数组，不需要为每条弹幕再建一个列表
+        content["danmuku"] = list(danmuku.rows())
+    else:
+        content["danmuku"] = danmuku.to_list()
+    # 字段顺序与 DanmukuResponse 一致，两种输出方式得到相同的字节
+    content["partial"] = partial
+    content["platforms"] = platforms or {}
+    if FAST_RESPONSE:
+        return DanmukuJSONResponse(content)
+    return content
+
+
+def result_response(name: str, result: Dict[str, Any]) -> Any:
+    return danmu_response(name, result["danmu"], result["platforms"], result["partial"])
+
+
+class SegmentStatsMiddleware:
+    """统计每个请求发起的分段下载，写入 X-Danmu-Segments 响应头
+
+    流式接口的响应头在抓取开始前就已发送，统计结果放在最后一行汇总信息中。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        with track_segments() as stats:
+
+            async def send_with_stats(message):
+                if message["type"] == "http.response.start" and stats.segments:
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"x-danmu-segments", stats.header().encode()),
+                        ],
+                    }
+                await send(message)
+
+            await self.app(scope, receive, send_with_stats)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with session_pool_lifespan(), cache_lifespan(), decode_pool_lifespan():
+        yield
 
 
 # 创建 FastAPI 应用实例
@@ -31,6 +132,7 @@ fastapi_app = FastAPI(
         "url": "https://github.com/SeqCrafter/fetch_danmu",
         "email": "sdupan2015@gmail.com",
     },
+    lifespan=lifespan,
 )
 
 # 添加 CORS 中间件
@@ -40,41 +142,48 @@ fastapi_app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Danmu-Segments"],
 )
+fastapi_app.add_middleware(SegmentStatsMiddleware)
+
+
+### 客户端已经断开，响应不会被读取，状态码沿用 nginx 的 499
+@fastapi_app.exception_handler(ClientDisconnect)
+async def client_disconnected(request: Request, exc: ClientDisconnect) -> Response:
+    return Response(status_code=499)
 
 
 @fastapi_app.get("/api/url", response_model=DanmukuResponse)
 async def danmu_by_url(
+    request: Request,
     url: Annotated[str, Query(description="视频URL地址", pattern=r"^https?://.*$")],
 ):
     """通过URL直接获取弹幕"""
     # URL解码
     decoded_url = unquote_plus(url)
-    danmu_data = await get_danmu_by_url(decoded_url)
-    return {
-        "code": 0,
-        "name": decoded_url,
-        "danmu": len(danmu_data),
-        "danmuku": danmu_data,
-    }
+    with request_budget():
+        result = await cancel_on_disconnect(
+            request, lambda: get_danmu_by_url(decoded_url)
+        )
+    return result_response(decoded_url, result)
 
 
 @fastapi_app.get("/api/douban_id", response_model=DanmukuResponse)
 async def danmu_by_douban_id(
+    request: Request,
     douban_id: Annotated[int, Query(description="豆瓣ID")],
     episode_number: Annotated[int, Query(description="集数")],
 ):
-    all_danmu = await get_danmu_by_id(str(douban_id), str(episode_number))
-    return {
-        "code": 0,
-        "name": str(douban_id),
-        "danmu": len(all_danmu),
-        "danmuku": all_danmu,
-    }
+    with request_budget():
+        result = await cancel_on_disconnect(
+            request, lambda: get_danmu_by_id(str(douban_id), str(episode_number))
+        )
+    return result_response(str(douban_id), result)
 
 
 @fastapi_app.get("/api/title", response_model=DanmukuResponse)
 async def danmu_by_title(
+    request: Request,
     title: Annotated[str, Query(description="视频名称")],
     season_number: Annotated[int, Query(description="季数")],
     season: Annotated[bool, Query(description="是否为连续剧, true/false")],
@@ -82,19 +191,19 @@ async def danmu_by_title(
 ):
     """通过视频名称直接获取弹幕"""
 
-    all_danmu = await get_danmu_by_title(
-        title, str(season_number), season, str(episode_number)
-    )
-    return {
-        "code": 0,
-        "name": title,
-        "danmu": len(all_danmu),
-        "danmuku": all_danmu,
-    }
+    with request_budget():
+        result = await cancel_on_disconnect(
+            request,
+            lambda: get_danmu_by_title(
+                title, str(season_number), season, str(episode_number)
+            ),
+        )
+    return result_response(title, result)
 
 
 @fastapi_app.get("/api/test/title", response_model=DanmukuResponse)
 async def danmu_by_title_caiji(
+    request: Request,
     title: Annotated[str, Query(description="视频名称")],
     season: Annotated[bool, Query(description="是否为连续剧, true/false")],
     episode_number: Annotated[int, Query(description="集数")],
@@ -102,19 +211,76 @@ async def danmu_by_title_caiji(
 ):
     """通过视频名称直接获取弹幕（测试版本）"""
 
-    if season:
-        all_danmu = await get_danmu_by_title_caiji(title, episode_number)
-    else:
-        all_danmu = await get_danmu_by_title_caiji(title, 1)
+    all_danmu = await cancel_on_disconnect(
+        request,
+        lambda: get_danmu_by_title_caiji(title, episode_number if season else 1),
+    )
     ## to avoid type error
     print(season_number)
 
-    return {
-        "code": 0,
-        "name": title,
-        "danmu": len(all_danmu),
-        "danmuku": all_danmu,
-    }
+    return danmu_response(title, all_danmu)
+
+
+async def ndjson_danmu_stream(name: str, urls: List[str]) -> AsyncIterator[str]:
+    """逐行输出 JSON，每取得一个分段就输出其中的弹幕，最后一行为汇总信息"""
+    # 客户端断开后 StreamingResponse 不再读取，及时关闭内层生成器以取消还在进行的抓取
+    async with contextlib.aclosing(stream_platforms_danmu(urls)) as stream:
+        async for item in stream:
+            if item.get("end"):
+                segments = current_stats().as_dict()
+                item = {"code": 0, "name": name, **item, "segments": segments}
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+
+def ndjson_response(name: str, urls: List[str]) -> StreamingResponse:
+    return StreamingResponse(
+        ndjson_danmu_stream(name, urls), media_type="application/x-ndjson"
+    )
+
+
+@fastapi_app.get("/api/stream/url")
+async def stream_danmu_by_url(
+    url: Annotated[str, Query(description="视频URL地址", pattern=r"^https?://.*$")],
+):
+    """通过URL流式获取弹幕（NDJSON）"""
+    decoded_url = unquote_plus(url)
+    return ndjson_response(decoded_url, [decoded_url])
+
+
+@fastapi_app.get("/api/stream/douban_id")
+async def stream_danmu_by_douban_id(
+    request: Request,
+    douban_id: Annotated[int, Query(description="豆瓣ID")],
+    episode_number: Annotated[int, Query(description="集数")],
+):
+    """通过豆瓣ID流式获取弹幕（NDJSON）"""
+    urls = await cancel_on_disconnect(
+        request, lambda: get_platform_urls_by_id(str(douban_id))
+    )
+    return ndjson_response(
+        str(douban_id), select_episode_urls(urls, str(episode_number))
+    )
+
+
+@fastapi_app.get("/api/stream/title")
+async def stream_danmu_by_title(
+    request: Request,
+    title: Annotated[str, Query(description="视频名称")],
+    season_number: Annotated[int, Query(description="季数")],
+    season: Annotated[bool, Query(description="是否为连续剧, true/false")],
+    episode_number: Annotated[int, Query(description="集数")],
+):
+    """通过视频名称流式获取弹幕（NDJSON）"""
+    urls = await cancel_on_disconnect(
+        request, lambda: get_platform_urls_by_title(title, str(season_number), season)
+    )
+    return ndjson_response(title, select_episode_urls(urls, str(episode_number)))
+
+
+@fastapi_app.get("/api/limits")
+async def host_limit_stats():
+    """各主机当前的并发限制、进行中的请求数和平均延迟"""
+    return host_limits.snapshot()
 
 
 @fastapi_app.get("/api/proxy/image")
@@ -0,0 +1,351 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import time
+import zlib
+from collections import OrderedDict
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+from .provides.columns import DanmuColumns
+from .retry import current_stats, fetch_with_retry
+
+REDIS_URL = os.getenv(
+    "DANMU_REDIS_URL", os.getenv("REFLEX_REDIS_URL", "redis://localhost")
+)
+### 进程内 LRU 最多保存的条目数
+LRU_SIZE = int(os.getenv("DANMU_CACHE_LRU_SIZE", "64"))
+### 进程内缓存过期时间（秒），短一些以便及时看到 Redis 中的新结果
+LOCAL_TTL = int(os.getenv("DANMU_CACHE_LOCAL_TTL", "60"))
+### Redis 缓存过期时间（秒）
+REDIS_TTL = int(os.getenv("DANMU_CACHE_TTL", "600"))
+### Redis 连接失败后暂停使用的时间（秒），避免每个请求都等待超时
+REDIS_RETRY_AFTER = 30
+### 分段缓存：进程内条目数、普通分段和末尾分段的过期时间（秒）
+SEGMENT_LRU_SIZE = int(os.getenv("DANMU_SEGMENT_LRU_SIZE", "2048"))
+SEGMENT_TTL = int(os.getenv("DANMU_SEGMENT_TTL", "21600"))
+SEGMENT_TAIL_TTL = int(os.getenv("DANMU_SEGMENT_TAIL_TTL", "300"))
+### 最后几个分段仍可能有新弹幕写入（连载中的剧集），使用较短的过期时间
+SEGMENT_TAIL = 2
+### 第一次抓取一集的分段超过这么久（秒）后视为已经稳定，末尾分段也使用长过期时间
+SEGMENT_SETTLE_AFTER = int(os.getenv("DANMU_SEGMENT_SETTLE", "259200"))
+### 记录一集第一次被抓取时间的条目的过期时间（秒），需要比 SEGMENT_SETTLE_AFTER 长
+EPISODE_SEEN_TTL = 30 * 24 * 3600
+
+
+def _encode_default(value: Any) -> Any:
+    if isinstance(value, DanmuColumns):
+        return {"__columns__": value.to_payload()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_hook(obj: dict) -> Any:
+    if "__columns__" in obj:
+        return DanmuColumns.from_payload(obj["__columns__"])
+    return obj
+
+
+def encode_value(value: Any) -> bytes:
+    return zlib.compress(
+        json.dumps(
+            value, ensure_ascii=False, separators=(",", ":"), default=_encode_default
+        ).encode("utf-8")
+    )
+
+
+def decode_value(data: bytes) -> Any:
+    return json.loads(zlib.decompress(data), object_hook=_decode_hook)
+
+
+def make_key(namespace: str, *args: Any) -> str:
+    digest = hashlib.sha1(
+        json.dumps(args, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+    return f"danmu:{namespace}:{digest}"
+
+
+class LRUCache:
+    """带过期时间的进程内 LRU 缓存"""
+
+    def __init__(self, maxsize: int = LRU_SIZE):
+        self.maxsize = maxsize
+        self._data: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expire_at, value = item
+        if expire_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class TwoTierCache:
+    """进程内 LRU + Redis 两级缓存，Redis 中保存压缩后的 JSON"""
+
+    def __init__(
+        self,
+        redis_url: str = REDIS_URL,
+        maxsize: int = LRU_SIZE,
+        local_ttl: float = LOCAL_TTL,
+    ):
+        self.redis_url = redis_url
+        self.local = LRUCache(maxsize)
+        self.local_ttl = local_ttl
+        self._redis: Optional[aioredis.Redis] = None
+        self._redis_down_until = 0.0
+
+    @property
+    def redis(self) -> Optional[aioredis.Redis]:
+        if not self.redis_url or self._redis_down_until > time.monotonic():
+            return None
+        if self._redis is None:
+            self._redis = aioredis.from_url(
+                self.redis_url, socket_connect_timeout=1, socket_timeout=2
+            )
+        return self._redis
+
+    def _redis_failed(self, e: Exception) -> None:
+        print(f"Redis 缓存不可用: {e}")
+        self._redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        redis = self.redis
+        if redis is None:
+            return None
+        try:
+            data = await redis.get(key)
+        except (RedisError, OSError) as e:
+            self._redis_failed(e)
+            return None
+        if data is None:
+            return None
+        value = decode_value(data)
+        self.local.set(key, value, self.local_ttl)
+        return value
+
+    async def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        values = [self.local.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        redis = self.redis
+        if not missing or redis is None:
+            return values
+        try:
+            data_list = await redis.mget([keys[i] for i in missing])
+        except (RedisError, OSError) as e:
+            self._redis_failed(e)
+            return values
+        for i, data in zip(missing, data_list):
+            if data is not None:
+                values[i] = decode_value(data)
+                self.local.set(keys[i], values[i], self.local_ttl)
+        return values
+
+    async def set(self, key: str, value: Any, ttl: float = REDIS_TTL) -> None:
+        self.local.set(key, value, min(ttl, self.local_ttl))
+        redis = self.redis
+        if redis is None:
+            return
+        try:
+            await redis.set(key, encode_value(value), ex=max(int(ttl), 1))
+        except (RedisError, OSError) as e:
+            self._redis_failed(e)
+
+    async def set_many(self, items: List[Tuple[str, Any, float]]) -> None:
+        if not items:
+            return
+        for key, value, ttl in items:
+            self.local.set(key, value, min(ttl, self.local_ttl))
+        redis = self.redis
+        if redis is None:
+            return
+        try:
+            pipe = redis.pipeline(transaction=False)
+            for key, value, ttl in items:
+                pipe.set(key, encode_value(value), ex=max(int(ttl), 1))
+            await pipe.execute()
+        except (RedisError, OSError) as e:
+            self._redis_failed(e)
+
+    async def close(self) -> None:
+        self.local.clear()
+        if self._redis is not None:
+            redis, self._redis = self._redis, None
+            try:
+                await redis.aclose()
+            except (RedisError, OSError) as e:
+                print(f"关闭 Redis 连接失败: {e}")
+
+
+danmu_cache = TwoTierCache()
+segment_cache = TwoTierCache(maxsize=SEGMENT_LRU_SIZE, local_ttl=SEGMENT_TAIL_TTL)
+
+
+def cached(
+    namespace: str, ttl: float = REDIS_TTL, cache_if: Callable[[Any], bool] = bool
+) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+    """按参数缓存异步函数的结果，空结果不缓存，避免把上游失败缓存下来
+
+    ``cache_if`` 判断结果是否值得缓存，默认只要求结果非空。
+    """
+
+    def decorator(
+        func: Callable[..., Awaitable[Any]],
+    ) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any) -> Any:
+            key = make_key(namespace, *args)
+            value = await danmu_cache.get(key)
+            if value is not None:
+                return value
+            value = await func(*args)
+            if cache_if(value):
+                await danmu_cache.set(key, value, ttl)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+_segment_sink: contextvars.ContextVar[
+    Optional[Callable[[DanmuColumns], None]]
+] = contextvars.ContextVar("segment_sink", default=None)
+
+
+@contextlib.contextmanager
+def on_segments(callback: Callable[[DanmuColumns], None]) -> Iterator[None]:
+    """在此范围内（包括其中创建的任务）每个分段一取得就交给 callback，
+    不等整个平台抓取完成；命中缓存的分段也一样，空分段和失败的分段不会交出"""
+    token = _segment_sink.set(callback)
+    try:
+        yield
+    finally:
+        _segment_sink.reset(token)
+
+
+def segment_ttl(tail: bool, settled: bool = False) -> float:
+    """连载中剧集的末尾分段可能还在增长，过期时间短；之前的分段以及已经稳定的
+    剧集的所有分段基本不再变化，过期时间长"""
+    if tail and not settled:
+        return SEGMENT_TAIL_TTL
+    return SEGMENT_TTL
+
+
+def probed_tail(results: List[Any], index: int) -> bool:
+    """探测时不知道一集的分段总数，之后 SEGMENT_TAIL 个分段内出现空分段的视为末尾；
+    这批的最后几个分段之后情况未知，按普通分段处理"""
+    return not all(results[index + 1 : index + 1 + SEGMENT_TAIL])
+
+
+def is_settled(first_seen: Optional[float], now: float) -> bool:
+    """第一次抓取这一集已经超过 SEGMENT_SETTLE_AFTER 秒，说明不是刚上线的剧集，
+    末尾分段不会再有明显变化；没有记录时按连载中处理"""
+    return first_seen is not None and now - first_seen >= SEGMENT_SETTLE_AFTER
+
+
+async def fetch_segments(
+    namespace: str,
+    keys: List[str],
+    fetch: Callable[[int], Awaitable[Optional[DanmuColumns]]],
+    return_exceptions: bool = False,
+    episode: Optional[str] = None,
+    probing: bool = False,
+) -> List[Any]:
+    """按分段读取缓存，只有未命中的分段才调用 ``fetch(index)`` 重新下载
+
+    返回值与 ``asyncio.gather`` 一致，按 ``keys`` 的顺序排列。``fetch`` 抛出异常
+    或返回 ``None`` 时按 ``fetch_with_retry`` 退避重试，仍然失败的分段记为丢失，
+    以空分段返回且不写入缓存，单个分段失败不会让整个平台失败；空分段只按末尾
+    分段缓存一小段时间，避免把被吞掉的上游错误长期缓存下来。
+
+    第一次抓取一集时在缓存中记下时间（以 ``episode`` 区分剧集，默认是第一个
+    分段的 key），之后按这个时间判断末尾分段是否还需要短过期时间，见 ``is_settled``。
+    分批探测分段的调用方传入 ``probing=True``：``keys`` 只是一集中的一批，
+    末尾按 ``probed_tail`` 判断，而不是把每批的最后几个分段都当作末尾。
+    在 ``on_segments`` 范围内调用时，每个分段取得后立即交给回调。
+    """
+    if not keys:
+        return []
+    total = len(keys)
+    cache_keys = [f"danmu:seg:{namespace}:{key}" for key in keys]
+    seen_key = f"danmu:seg:{namespace}:{episode or keys[0]}:first_seen"
+    results = await segment_cache.get_many(cache_keys + [seen_key])
+    first_seen = results.pop()
+    now = time.time()
+    settled = is_settled(first_seen, now)
+    missing = [i for i, value in enumerate(results) if value is None]
+    stats = current_stats()
+    stats.segments += total
+    stats.cached += total - len(missing)
+    sink = _segment_sink.get()
+
+    async def fetch_one(index: int) -> Optional[DanmuColumns]:
+        value = await fetch_with_retry(namespace, functools.partial(fetch, index))
+        if sink is not None and value:
+            sink(value)
+        return value
+
+    if sink is not None:
+        for value in results:
+            if value:
+                sink(value)
+    fetched = await asyncio.gather(
+        *(fetch_one(i) for i in missing), return_exceptions=return_exceptions
+    )
+    for i, value in zip(missing, fetched):
+        results[i] = DanmuColumns() if value is None else value
+    items = []
+    for i, value in zip(missing, fetched):
+        if not isinstance(value, DanmuColumns):
+            continue
+        if not value:
+            ttl = SEGMENT_TAIL_TTL
+        else:
+            tail = probed_tail(results, i) if probing else i >= total - SEGMENT_TAIL
+            ttl = segment_ttl(tail, settled)
+        items.append((cache_keys[i], value, ttl))
+    if first_seen is None:
+        items.append((seen_key, now, EPISODE_SEEN_TTL))
+    await segment_cache.set_many(items)
+    return results
+
+
+@contextlib.asynccontextmanager
+async def cache_lifespan() -> AsyncIterator[None]:
+    """应用退出时关闭 Redis 连接"""
+    try:
+        yield
+    finally:
+        await danmu_cache.close()
+        await segment_cache.close()
@@ -1,5 +1,8 @@
 import reflex as rx
 from .api import fastapi_app
+from .provides.session import session_pool_lifespan
+from .cache import cache_lifespan
+from .provides.executor import decode_pool_lifespan
 
 app = rx.App(
     theme=rx.theme(
@@ -8,3 +11,6 @@ app = rx.App(
     ),
     api_transformer=fastapi_app,
 )
+app.register_lifespan_task(session_pool_lifespan)
+app.register_lifespan_task(cache_lifespan)
+app.register_lifespan_task(decode_pool_lifespan)
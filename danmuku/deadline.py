@@ -0,0 +1,51 @@
+import contextlib
+import contextvars
+import math
+import os
+import time
+from typing import Iterator, Optional
+
+### 一次弹幕请求的总时间预算（秒），到期后返回已经合并的部分结果
+REQUEST_BUDGET = float(os.getenv("DANMU_REQUEST_BUDGET", "20"))
+### 单个平台抓取弹幕的时间上限（秒）
+PLATFORM_TIMEOUT = float(os.getenv("DANMU_PLATFORM_TIMEOUT", "15"))
+### 单个分段每次请求的时间上限（秒），超时后按失败重试
+SEGMENT_TIMEOUT = float(os.getenv("DANMU_SEGMENT_TIMEOUT", "8"))
+### 部分结果返回后，是否在后台继续抓取剩余平台并把完整结果写入缓存
+FINISH_IN_BACKGROUND = os.getenv("DANMU_FINISH_IN_BACKGROUND", "1") == "1"
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "request_deadline", default=None
+)
+
+
+@contextlib.contextmanager
+def request_budget(seconds: Optional[float] = REQUEST_BUDGET) -> Iterator[None]:
+    """在此范围内的抓取共享一个截止时间，seconds 为 None 或不大于 0 时不限时"""
+    deadline = time.monotonic() + seconds if seconds and seconds > 0 else None
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def unlimited() -> Iterator[None]:
+    """后台补全缓存时使用，请求预算和平台时间上限都不再生效"""
+    token = _deadline.set(math.inf)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining(limit: Optional[float] = None) -> Optional[float]:
+    """距离截止时间还剩多少秒，再与 limit 取较小值；都没有时返回 None"""
+    deadline = _deadline.get()
+    if deadline == math.inf:
+        return None
+    left = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+    if limit is None or limit <= 0:
+        return left
+    return limit if left is None else min(left, limit)
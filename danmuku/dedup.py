@@ -0,0 +1,65 @@
+from array import array
+from typing import Optional
+
+import numpy as np
+
+from .provides.columns import DanmuColumns
+
+### 按 benchmarks/dedup.py 的测量设置使用 NumPy 去重的条数范围：几百条以下固定开销
+### 不划算；几十万条以上时查字典的访存成为瓶颈，两种实现基本持平，改回逐条遍历
+VECTORIZE_MIN_ROWS = 500
+VECTORIZE_MAX_ROWS = 300_000
+
+
+def text_ids(danmu: DanmuColumns) -> np.ndarray:
+    """每条弹幕的文本第一次出现的下标，文本相同的弹幕得到相同的值
+
+    按原来的顺序顺序访问文本，字典的查找和插入都在 C 中完成。
+    """
+    first: dict = {}
+    return np.fromiter(
+        map(first.setdefault, danmu.texts, range(len(danmu))),
+        dtype=np.intp,
+        count=len(danmu),
+    )
+
+
+def take(danmu: DanmuColumns, indices: np.ndarray) -> DanmuColumns:
+    """与 ``DanmuColumns.take`` 相同，数值列直接在缓冲区上按下标取值"""
+    out = DanmuColumns()
+    for name in ("times", "positions", "colors", "sizes"):
+        column = getattr(danmu, name)
+        picked = array(column.typecode)
+        picked.frombytes(np.frombuffer(column, dtype=column.typecode)[indices].tobytes())
+        setattr(out, name, picked)
+    out.texts = list(map(danmu.texts.__getitem__, indices.tolist()))
+    return out
+
+
+def earliest_by_text(
+    danmu: DanmuColumns, by_first_seen: bool
+) -> Optional[np.ndarray]:
+    """每个文本保留时间最早的一条（时间相同时取下标最小的），返回按时间排序的下标
+
+    时间相同的弹幕，``by_first_seen`` 为真时按文本第一次出现的先后排列
+    （``deduplicate_danmu`` 的顺序），否则按保留下来的下标排列
+    （``merge_danmu`` 的顺序）。时间中有 NaN 时返回 None，由调用方退回逐条
+    比较的实现。
+    """
+    times = np.frombuffer(danmu.times, dtype=np.float64)
+    if np.isnan(times).any():
+        return None
+    count = len(times)
+    ids = text_ids(danmu)
+    # 按时间稳定排序后，每个文本排在最前的位置就是它最早的一条
+    order = np.argsort(times, kind="stable")
+    earliest = np.full(count, count, dtype=np.intp)
+    np.minimum.at(earliest, ids[order], np.arange(count))
+    # 下标是文本第一次出现的位置，按下标取出即按文本第一次出现的先后排列
+    kept = earliest[earliest < count]
+    if not by_first_seen:
+        # 时间相同时排序位置的先后就是下标的先后
+        kept.sort()
+        return order[kept]
+    indices = order[kept]
+    return indices[np.argsort(times[indices], kind="stable")]
@@ -0,0 +1,69 @@
+import asyncio
+import contextlib
+import contextvars
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterator, Optional
+
+from starlette.requests import ClientDisconnect, Request
+
+
+@dataclass
+class ClientState:
+    """发起当前工作的客户端是否已经断开"""
+
+    gone: bool = False
+
+
+_client: contextvars.ContextVar[Optional[ClientState]] = contextvars.ContextVar(
+    "client_state", default=None
+)
+
+
+def client_gone() -> bool:
+    """当前工作是否已经没有客户端在等待，此时被取消的等待不需要保留共享的任务"""
+    client = _client.get()
+    return client is not None and client.gone
+
+
+@contextlib.contextmanager
+def client_scope(client: Optional[ClientState] = None) -> Iterator[ClientState]:
+    """在此范围内（包括其中创建的任务）的工作属于同一个客户端"""
+    client = client or ClientState()
+    token = _client.set(client)
+    try:
+        yield client
+    finally:
+        _client.reset(token)
+
+
+async def wait_disconnected(request: Request) -> None:
+    """等到客户端断开，与 StreamingResponse 的 listen_for_disconnect 相同的做法"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(
+    request: Request, func: Callable[[], Awaitable[Any]]
+) -> Any:
+    """执行 func，客户端提前断开时取消它并抛出 ClientDisconnect
+
+    只有这个请求独占的工作会被取消：仍有其他请求在等待的 single flight
+    和后台补全缓存的任务会继续执行。
+    """
+    with client_scope() as client:
+        work = asyncio.ensure_future(func())
+        watcher = asyncio.ensure_future(wait_disconnected(request))
+        try:
+            await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if work.done():
+                return work.result()
+            raise ClientDisconnect()
+        finally:
+            watcher.cancel()
+            if not work.done():
+                # 先标记客户端断开再取消，等待中的 single flight 据此判断是否一起取消
+                client.gone = True
+                work.cancel()
+                await asyncio.wait({work})
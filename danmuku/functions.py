@@ -1,9 +1,4 @@
-from .provides.bilibili.bilibili import get_bilibili_danmu, get_bilibili_episode_url
-from .provides.iqiyi.iqiyi import get_iqiyi_danmu, get_iqiyi_episode_url
-from .provides.mgtv import get_mgtv_danmu, get_mgtv_episode_url
-from .provides.souhu import get_souhu_danmu, get_souhu_episode_url
-from .provides.tencent import get_tencent_danmu, get_tencent_episode_url
-from .provides.youku import get_youku_danmu, get_youku_episode_url
+from .provides.registry import find_provider
 from .provides.utils import other2http
 from .provides.doubai import (
     get_platform_link,
@@ -12,101 +7,295 @@ from .provides.doubai import (
     douban_select,
 )
 import asyncio
+import os
 from .provides.caiji import get_vod_links_from_name
-from typing import List, Dict, Optional, Any
+from .cache import cached, make_key, on_segments
+from .dedup import VECTORIZE_MAX_ROWS, VECTORIZE_MIN_ROWS, earliest_by_text, take
+from .deadline import FINISH_IN_BACKGROUND, PLATFORM_TIMEOUT, remaining, unlimited
+from .disconnect import ClientState, client_scope
+from .retry import track_segments
+from .singleflight import single_flight
+from .provides.columns import DanmuColumns
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import urlparse
+
+### 同一集在多个平台上的弹幕同时抓取的平台数上限
+PLATFORM_CONCURRENCY = int(os.getenv("DANMU_PLATFORM_CONCURRENCY", "4"))
+### 流式接口每行最多输出的弹幕条数
+STREAM_BATCH_SIZE = 2000
 
 
-def deduplicate_danmu(danmu_list: List[List[Any]]) -> List[List[Any]]:
-    if not danmu_list:
-        return danmu_list
+def deduplicate_danmu(danmu: DanmuColumns) -> DanmuColumns:
+    if not danmu:
+        return danmu
+    if VECTORIZE_MIN_ROWS <= len(danmu) <= VECTORIZE_MAX_ROWS:
+        indices = earliest_by_text(danmu, by_first_seen=True)
+        if indices is not None:
+            return take(danmu, indices)
 
-    # 使用字典来存储每个text对应的最早弹幕
-    seen_texts = {}
-    deduplicated = []
+    times = danmu.times
+    # 使用字典来存储每个text对应的最早弹幕的下标，字典保持text第一次出现的顺序
+    earliest = {}
+    for index, text in enumerate(danmu.texts):
+        existing_idx = earliest.get(text)
+        # 如果当前弹幕时间更早，替换已存储的弹幕
+        if existing_idx is None or times[index] < times[existing_idx]:
+            earliest[text] = index
+
+    # 按时间重新排序（因为可能有替换操作）
+    return danmu.take(sorted(earliest.values(), key=times.__getitem__))
 
-    for danmu in danmu_list:
-        text = danmu[4]  # text是第5个元素，索引为4
-        time = danmu[0]  # time是第1个元素，索引为0
 
+def first_by_text(danmu: DanmuColumns, seen_texts: set) -> List[int]:
+    """按时间顺序返回每个文本第一次出现的下标，跳过 seen_texts 中已有的文本"""
+    texts = danmu.texts
+    indices = []
+    for index in sorted(range(len(danmu)), key=danmu.times.__getitem__):
+        text = texts[index]
         if text not in seen_texts:
-            seen_texts[text] = len(deduplicated)
-            deduplicated.append(danmu)
-        else:
-            # 如果当前弹幕时间更早，替换已存储的弹幕
-            existing_idx = seen_texts[text]
-            if time < deduplicated[existing_idx][0]:
-                deduplicated[existing_idx] = danmu
+            seen_texts.add(text)
+            indices.append(index)
+    return indices
 
-    # 按时间重新排序（因为可能有替换操作）
-    deduplicated.sort(key=lambda x: x[0])
 
-    return deduplicated
+def merge_danmu(runs: List[DanmuColumns]) -> DanmuColumns:
+    """合并多段弹幕，按时间排序，同时按文本去重，每个文本只保留最早的一条
+
+    各段（平台）内的弹幕由按时间排列的分段拼接而成，本身基本有序。拼接后按
+    时间对下标排序会被 timsort 识别为若干有序段并直接归并，代价接近一次 k 路
+    归并；去重在归并后的同一遍遍历中完成，不再需要第二次排序。保留的弹幕与
+    拼接后调用 ``deduplicate_danmu`` 相同，时间相同的弹幕按下标排列。条数较多
+    时改用 NumPy 排序（见 ``dedup.VECTORIZE_MIN_ROWS``），结果与逐条遍历完全相同。
+    """
+    merged = runs[0] if len(runs) == 1 else DanmuColumns.concat(runs)
+    if VECTORIZE_MIN_ROWS <= len(merged) <= VECTORIZE_MAX_ROWS:
+        indices = earliest_by_text(merged, by_first_seen=False)
+        if indices is not None:
+            return take(merged, indices)
+    return merged.take(first_by_text(merged, set()))
 
 
 ### url是官方视频播放链接
-async def get_all_danmu(url: str) -> List[List[Any]]:
-    all_danmu = []
-    """使用异步并行执行所有平台获取弹幕"""
-    if "mgtv.com" in url:
-        results = await get_mgtv_danmu(url)
-    elif "v.qq.com" in url:
-        results = await get_tencent_danmu(url)
-    elif "youku.com" in url:
-        results = await get_youku_danmu(url)
-    elif "iqiyi.com" in url:
-        results = await get_iqiyi_danmu(url)
-    elif "bilibili.com" in url:
-        results = await get_bilibili_danmu(url)
-    elif "tv.sohu.com" in url:
-        results = await get_souhu_danmu(url)
-    else:
-        results = []
-    if not results:
-        return all_danmu
+@single_flight("platform")
+async def get_all_danmu(url: str) -> DanmuColumns:
+    """根据链接所属平台获取弹幕"""
+    provider = find_provider(url)
+    if provider is None:
+        return DanmuColumns()
+    return await provider.fetch_danmu(url)
 
-    all_danmu = [
-        [
-            item["time"],
-            item["position"],
-            item["color"],
-            item["size"],
-            item["text"],
-        ]
-        for item in results
-    ]
-    return all_danmu
+
+def platform_name(url: str) -> str:
+    provider = find_provider(url)
+    return provider.name if provider else urlparse(url).hostname
+
+
+async def get_platforms_danmu(
+    urls: List[str],
+) -> Tuple[List[DanmuColumns], Dict[str, Dict[str, Any]]]:
+    """并发获取同一集在各个平台上的弹幕，每个平台一段，单个平台失败不影响其他平台
+
+    每个平台最多等待 ``PLATFORM_TIMEOUT`` 秒，全部平台不超过请求剩余的时间预算，
+    超时的平台记为 ``timeout``。被放弃等待的平台抓取仍在 single flight 中继续，
+    分段会照常写入缓存。同时返回各平台的状态和原始弹幕条数。
+
+    本身被取消（客户端断开）时一起取消各平台的抓取，与其他请求共享的除外。
+    """
+    semaphore = asyncio.Semaphore(PLATFORM_CONCURRENCY)
+
+    async def fetch(single_url: str) -> Any:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(
+                    get_all_danmu(single_url), remaining(PLATFORM_TIMEOUT)
+                )
+            except Exception as e:
+                return e
+
+    tasks = [asyncio.create_task(fetch(single_url)) for single_url in urls]
+    try:
+        if tasks:
+            await asyncio.wait(tasks, timeout=remaining())
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    runs = []
+    platforms = {}
+    # 按平台链接的顺序排列，归并时相同时间的弹幕保持与逐个获取时相同的顺序
+    for single_url, task in zip(urls, tasks):
+        platform = platform_name(single_url)
+        if not task.done():
+            task.cancel()
+            platforms[platform] = {"status": "timeout", "danmu": 0}
+            continue
+        result = task.result()
+        if isinstance(result, asyncio.TimeoutError):
+            platforms[platform] = {"status": "timeout", "danmu": 0}
+        elif isinstance(result, Exception):
+            print(f"获取弹幕失败 {single_url}: {result}")
+            platforms[platform] = {"status": "error", "danmu": 0}
+        else:
+            runs.append(result)
+            platforms[platform] = {
+                "status": "ok" if result else "empty",
+                "danmu": len(result),
+            }
+    return runs, platforms
+
+
+def danmu_result(
+    danmu: DanmuColumns, platforms: Optional[Dict[str, Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    """弹幕接口的结果：合并后的弹幕、各平台状态，以及是否因为超时只有部分平台"""
+    platforms = platforms or {}
+    return {
+        "danmu": danmu,
+        "platforms": platforms,
+        "partial": any(p["status"] == "timeout" for p in platforms.values()),
+    }
+
+
+def is_complete(result: Dict[str, Any]) -> bool:
+    """部分结果不缓存，下一次请求可以拿到后台补全后的完整结果"""
+    return bool(result["danmu"]) and not result["partial"]
+
+
+_background: Dict[str, asyncio.Task] = {}
+
+
+def finish_in_background(func: Callable[..., Awaitable[Any]], *args: Any) -> None:
+    """不限时地在后台重新执行一次 func，等还没完成的平台抓取结束后把完整结果写入缓存
+
+    func 需要是带缓存但不带 single flight 的一层，否则会加入当前这次还没结束的调用。
+    """
+    if not FINISH_IN_BACKGROUND:
+        return
+    key = make_key("background", func.__qualname__, *args)
+    if key in _background:
+        return
+
+    async def run() -> None:
+        # 补全缓存的任务不属于任何客户端，发起的请求断开时也继续执行
+        with unlimited(), track_segments(), client_scope():
+            try:
+                await func(*args)
+            except Exception as e:
+                print(f"后台补全弹幕失败: {e}")
+
+    task = asyncio.create_task(run())
+    _background[key] = task
+    task.add_done_callback(lambda _: _background.pop(key, None))
+
+
+async def stream_platforms_danmu(urls: List[str]) -> AsyncIterator[Dict[str, Any]]:
+    """各平台的分段一取得就产出其中的弹幕，不等整个平台抓取完成，最后产出汇总信息
+
+    每个分段的弹幕按时间排序，只与已经产出的弹幕按文本去重（先到先得），
+    所以结果可能与 ``get_platforms_danmu`` 合并后去重的结果略有不同。汇总中
+    各平台的 ``danmu`` 与非流式接口一样是去重前的条数，``sent`` 是去重后实际
+    输出的条数。平台抓取不经过 ``get_all_danmu`` 的 single flight，否则加入别人
+    已经开始的抓取时拿不到分段。
+    """
+    semaphore = asyncio.Semaphore(PLATFORM_CONCURRENCY)
+    client = ClientState()
+    # 元素为 (平台, 分段, False)，平台结束时为 (平台, 结果或异常, True)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def fetch(single_url: str) -> None:
+        platform = platform_name(single_url)
+        provider = find_provider(single_url)
+        with client_scope(client), on_segments(
+            lambda segment: queue.put_nowait((platform, segment, False))
+        ):
+            async with semaphore:
+                try:
+                    if provider is None:
+                        result: Any = DanmuColumns()
+                    else:
+                        result = await provider.fetch_danmu(single_url)
+                except Exception as e:
+                    result = e
+        queue.put_nowait((platform, result, True))
+
+    tasks = [asyncio.create_task(fetch(single_url)) for single_url in urls]
+    seen_texts = set()
+    platforms: Dict[str, Dict[str, Any]] = {}
+    total = 0
+    try:
+        running = len(tasks)
+        while running:
+            platform, item, finished = await queue.get()
+            stats = platforms.setdefault(
+                platform, {"status": "empty", "danmu": 0, "sent": 0}
+            )
+            if finished:
+                running -= 1
+                if isinstance(item, Exception):
+                    print(f"获取 {platform} 弹幕失败: {item}")
+                    stats["status"] = "error"
+                    continue
+                if not item or stats["danmu"]:
+                    continue
+                # 没有经过 fetch_segments 的平台拿不到分段，只能在结束时整体输出
+            stats["status"] = "ok"
+            stats["danmu"] += len(item)
+            batch = item.take(first_by_text(item, seen_texts)).to_list()
+            stats["sent"] += len(batch)
+            total += len(batch)
+            for start in range(0, len(batch), STREAM_BATCH_SIZE):
+                chunk = batch[start : start + STREAM_BATCH_SIZE]
+                yield {"platform": platform, "danmu": len(chunk), "danmuku": chunk}
+    finally:
+        # 消费者提前离开说明客户端已经断开，还没完成的平台抓取不再需要
+        client.gone = True
+        for task in tasks:
+            task.cancel()
+    yield {"end": True, "danmu": total, "platforms": platforms}
+
+
+def select_episode_urls(urls: Dict[str, List[str]], episode_number: str) -> List[str]:
+    """取出指定集数的平台链接，找不到时使用第一集"""
+    if not urls:
+        return []
+    if episode_number in urls:
+        return urls[episode_number]
+    return urls[list(urls.keys())[0]]
 
 
 ### 这里使用官方链接中的第一个链接，在官方网页中获取该视频的所有链接
 ### 每个平台都有自己的方法，该方法主要用于根据视频名称查询
 async def get_episode_url(platform_url_list: List[str]) -> Dict[str, List[str]]:
-    """获取所有剧集链接"""
+    """获取所有剧集链接，每个链接只交给所属平台解析"""
+    providers = [find_provider(platform_url) for platform_url in platform_url_list]
+    results = await asyncio.gather(
+        *(
+            provider.resolve_episodes(platform_url)
+            for provider, platform_url in zip(providers, platform_url_list)
+            if provider is not None
+        ),
+        return_exceptions=True,
+    )
     url_dict = {}
-    for platform_url in platform_url_list:
-        tasks = [
-            get_bilibili_episode_url(platform_url),
-            get_iqiyi_episode_url(platform_url),
-            get_souhu_episode_url(platform_url),
-            get_tencent_episode_url(platform_url),
-            get_youku_episode_url(platform_url),
-            get_mgtv_episode_url(platform_url),
-        ]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        ## 过滤掉空字典并合并
-        results = [
-            result for result in results if result and not isinstance(result, Exception)
-        ]
-        if len(results) == 0:
+    # 按平台链接的顺序合并所有结果
+    for result in results:
+        if not result or isinstance(result, Exception):
             continue
-        # 合并所有结果而不是只取第一个
-        for result in results:
-            for k, v in result.items():
-                if k not in url_dict.keys():
-                    url_dict[str(k)] = []
-                url_dict[str(k)].append(v)
+        for k, v in result.items():
+            url_dict.setdefault(str(k), []).append(v)
     return url_dict
 
 
+@single_flight("urls_by_id")
 async def get_platform_urls_by_id(douban_id: str) -> Dict[str, List[str]]:
     """获取豆瓣对应的平台链接"""
     platform_urls = await douban_get_first_url(douban_id)
@@ -117,6 +306,7 @@ async def get_platform_urls_by_id(douban_id: str) -> Dict[str, List[str]]:
     return url_dict
 
 
+@single_flight("urls_by_title")
 async def get_platform_urls_by_title(
     title: str, season_number: Optional[str], season: bool
 ) -> Dict[str, List[str]]:
@@ -146,57 +336,55 @@ async def get_platform_urls_by_title(
     return url_dict
 
 
-async def get_danmu_by_url(url: str) -> List[List[Any]]:
-    danmu_data = await get_all_danmu(url)
-    # 按时间排序
-    danmu_data.sort(key=lambda x: x[0])
-    # 去重复
-    danmu_data = deduplicate_danmu(danmu_data)
-    return danmu_data
+@single_flight("url")
+@cached("url", cache_if=is_complete)
+async def get_danmu_by_url(url: str) -> Dict[str, Any]:
+    runs, platforms = await get_platforms_danmu([url])
+    # 按时间排序并去重复
+    result = danmu_result(merge_danmu(runs) if runs else DanmuColumns(), platforms)
+    if result["partial"]:
+        finish_in_background(get_danmu_by_url.__wrapped__, url)
+    return result
 
 
-async def get_danmu_by_id(id: str, episode_number: str) -> List[List[Any]]:
-    all_danmu = []
+@single_flight("douban_id")
+@cached("douban_id", cache_if=is_complete)
+async def get_danmu_by_id(id: str, episode_number: str) -> Dict[str, Any]:
     urls = await get_platform_urls_by_id(id)
-    if not urls:
-        return all_danmu
-    if episode_number in urls:
-        url = urls[episode_number]
-    else:
-        url = urls[list(urls.keys())[0]]
-    for single_url in url:
-        danmu_data = await get_all_danmu(single_url)
-        all_danmu.extend(danmu_data)
-    # 按时间排序
-    all_danmu.sort(key=lambda x: x[0])
-    # 去重复
-    all_danmu = deduplicate_danmu(all_danmu)
-    return all_danmu
+    url = select_episode_urls(urls, episode_number)
+    if not url:
+        return danmu_result(DanmuColumns())
+    # 归并各平台弹幕，同时去重复
+    runs, platforms = await get_platforms_danmu(url)
+    result = danmu_result(merge_danmu(runs) if runs else DanmuColumns(), platforms)
+    if result["partial"]:
+        finish_in_background(get_danmu_by_id.__wrapped__, id, episode_number)
+    return result
 
 
+@single_flight("title")
+@cached("title", cache_if=is_complete)
 async def get_danmu_by_title(
     title: str, season_number: Optional[str], season: bool, episode_number: str
-) -> List[List[Any]]:
-    all_danmu = []
+) -> Dict[str, Any]:
     urls = await get_platform_urls_by_title(title, season_number, season)
-    if not urls:
-        return all_danmu
-    if episode_number in urls:
-        url = urls[episode_number]
-    else:
-        url = urls[list(urls.keys())[0]]
-    for single_url in url:
-        danmu_data = await get_all_danmu(single_url)
-        all_danmu.extend(danmu_data)
-    # 按时间排序
-    all_danmu.sort(key=lambda x: x[0])
-    # 去重复
-    all_danmu = deduplicate_danmu(all_danmu)
-    return all_danmu
+    url = select_episode_urls(urls, episode_number)
+    if not url:
+        return danmu_result(DanmuColumns())
+    # 归并各平台弹幕，同时去重复
+    runs, platforms = await get_platforms_danmu(url)
+    result = danmu_result(merge_danmu(runs) if runs else DanmuColumns(), platforms)
+    if result["partial"]:
+        finish_in_background(
+            get_danmu_by_title.__wrapped__, title, season_number, season, episode_number
+        )
+    return result
 
 
-async def get_danmu_by_title_caiji(title: str, episode_number: int) -> List[List[Any]]:
-    all_danmu = []
+@single_flight("title_caiji")
+@cached("title_caiji")
+async def get_danmu_by_title_caiji(title: str, episode_number: int) -> DanmuColumns:
+    all_danmu = DanmuColumns()
     urls = await get_vod_links_from_name(title)
     if not urls:
         return all_danmu
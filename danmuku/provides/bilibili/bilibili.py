@@ -1,18 +1,35 @@
-from typing import List
+from typing import List, Optional
 import re
 from curl_cffi import requests
 import urllib.parse
+import math
 import time
 from hashlib import md5
-from functools import reduce
 import asyncio
 
 # import provides.bilibili.bilibilidm_pb2 as Danmaku
 from . import bilibilidm_pb2 as Danmaku
-from ..utils import int_to_hex_color
+from ..utils import int_to_hex_color, resolve_url_query
+from ..session import session_pool
+from ...cache import fetch_segments
+from ..columns import DanmuColumns
+from ..registry import Provider, register_provider
 from typing import Dict, Any
 # import bilibilidm_pb2 as Danmaku
 
+API_SEGMENT = "https://api.bilibili.com/x/v2/dm/wbi/web/seg.so"
+### WBI 密钥每天轮换，缓存一段时间后主动刷新
+WBI_KEY_TTL = 3600
+### 密钥获取后至少使用这么久（秒）才允许因签名失败而作废
+WBI_KEY_MIN_AGE = 10
+### 每个弹幕分段覆盖 6 分钟（毫秒）
+SEGMENT_DURATION = 6 * 60 * 1000
+### 最多请求的分段数（6 小时）
+MAX_SEGMENTS = 60
+### 没有时长信息时每批探测的分段数，以及连续多少个空分段后停止
+PROBE_BATCH = 4
+EMPTY_SEGMENTS_STOP = 2
+
 mixinKeyEncTab = [
     46,
     47,
@@ -87,7 +104,7 @@ async def getWbiKeys() -> tuple[str, str]:
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
         "Referer": "https://www.bilibili.com/",
     }
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("bilibili") as client:
         resp = await client.get(
             "https://api.bilibili.com/x/web-interface/nav", headers=headers
         )
@@ -102,12 +119,45 @@ async def getWbiKeys() -> tuple[str, str]:
 
 def getMixinKey(orig: str) -> str:
     "对 imgKey 和 subKey 进行字符顺序打乱编码"
-    return reduce(lambda s, i: s + orig[i], mixinKeyEncTab, "")[:32]
+    return "".join(orig[i] for i in mixinKeyEncTab)[:32]
+
+
+class WbiKeyCache:
+    """进程内共享的 WBI 密钥，只在过期或签名失败时重新获取，mixin_key 每次轮换只计算一次"""
+
+    def __init__(self, ttl: float = WBI_KEY_TTL):
+        self.ttl = ttl
+        self._mixin_key: Optional[str] = None
+        self._fetched_at = 0.0
+        self._expire_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _valid(self) -> bool:
+        return self._mixin_key is not None and time.monotonic() < self._expire_at
+
+    async def get(self) -> str:
+        if self._valid():
+            return self._mixin_key
+        async with self._lock:
+            # 等锁期间可能已经被其他请求刷新
+            if not self._valid():
+                img_key, sub_key = await getWbiKeys()
+                self._mixin_key = getMixinKey(img_key + sub_key)
+                self._fetched_at = time.monotonic()
+                self._expire_at = self._fetched_at + self.ttl
+        return self._mixin_key
+
+    def invalidate(self) -> None:
+        # 刚刷新过的密钥不再作废，避免并发失败的分段反复刷新
+        if time.monotonic() - self._fetched_at >= WBI_KEY_MIN_AGE:
+            self._expire_at = 0.0
 
 
-def encWbi(params: dict, img_key: str, sub_key: str) -> Dict[str, Any]:
+wbi_keys = WbiKeyCache()
+
+
+def encWbi(params: dict, mixin_key: str) -> Dict[str, Any]:
     "为请求参数进行 wbi 签名"
-    mixin_key = getMixinKey(img_key + sub_key)
     curr_time = round(time.time())
     params["wts"] = curr_time  # 添加 wts 字段
     params = dict(sorted(params.items()))  # 按照 key 重排参数
@@ -122,14 +172,43 @@ def encWbi(params: dict, img_key: str, sub_key: str) -> Dict[str, Any]:
     return params
 
 
-async def get_link(url: str, client: requests.AsyncSession = None) -> List[str]:
+def build_segment_url(oid: Any, segment_index: Any, mixin_key: str) -> str:
+    params = {
+        "type": 1,
+        "oid": oid,
+        "segment_index": segment_index,
+    }
+    signed_params = encWbi(params=params, mixin_key=mixin_key)
+    return f"{API_SEGMENT}?{urllib.parse.urlencode(signed_params)}"
+
+
+def is_signature_failure(res: requests.Response) -> bool:
+    """分段接口正常返回 protobuf，签名失败时返回 412 或 JSON 错误信息"""
+    content_type = res.headers.get("content-type", "")
+    return res.status_code != 200 or content_type.startswith("application/json")
+
+
+def plan_segments(duration: Any) -> Optional[int]:
+    """按分集时长（毫秒）计算需要请求的 6 分钟分段数，没有时长时返回 None"""
+    try:
+        duration = int(duration)
+    except (TypeError, ValueError):
+        return None
+    if duration <= 0:
+        return None
+    return min(math.ceil(duration / SEGMENT_DURATION), MAX_SEGMENTS)
+
+
+async def get_episode(
+    url: str, client: requests.AsyncSession = None
+) -> Optional[Dict[str, Any]]:
+    """从番剧接口中找到链接对应的分集信息，包含 cid 和 duration"""
     api_epid_cid = "https://api.bilibili.com/pgc/view/web/season"
-    img_key, sub_key = await getWbiKeys()
     if url.find("bangumi/") != -1 and url.find("ep") != -1:
         epid_matches = re.findall(r"ep(\d+)", url)
         if not epid_matches:
             print("无法从URL中提取epid")
-            return []
+            return None
         epid = epid_matches[0]
         params = {"ep_id": epid}
 
@@ -137,38 +216,22 @@ async def get_link(url: str, client: requests.AsyncSession = None) -> List[str]:
         res_json = res.json()
         if res_json.get("code") != 0:
             print("获取番剧信息失败")
-            return []
-        target_episode = None
+            return None
         for episode in res_json.get("result", {}).get("episodes", []):
             if episode.get("id", 0) == int(epid):
-                target_episode = episode
-                break
-        if target_episode:
-            ret_data = []
-            for i in range(1, 20):
-                params = {
-                    "type": 1,
-                    "oid": target_episode.get("cid"),
-                    "segment_index": i,
-                }
-                signed_params = encWbi(params=params, img_key=img_key, sub_key=sub_key)
-                ret_data.append(
-                    "https://api.bilibili.com/x/v2/dm/wbi/web/seg.so?"
-                    + urllib.parse.urlencode(signed_params)
-                )
-            return ret_data
-        return []
+                return episode
+    return None
 
 
-def parse_data(data) -> List[Dict[str, Any]]:
-    barrage_list = []
+async def get_link(cid: Any, first: int, last: int) -> List[str]:
+    """生成第 first 到第 last 个分段的签名链接"""
+    mixin_key = await wbi_keys.get()
+    return [build_segment_url(cid, i, mixin_key) for i in range(first, last + 1)]
+
+
+def parse_data(data) -> DanmuColumns:
+    barrage_list = DanmuColumns()
     for elem in data.elems:
-        parsed_data = {}
-        parsed_data.setdefault("text", elem.content)
-        parsed_data.setdefault("time", float(elem.progress / 1000))
-        parsed_data.setdefault("color", int_to_hex_color(int(elem.color)))
-        parsed_data.setdefault("size", f"{elem.fontsize}px")
-        # parsed_data.setdefault("id", elem.idStr)
         mode = 0
         match elem.mode:
             case 1 | 2 | 3:
@@ -177,9 +240,13 @@ def parse_data(data) -> List[Dict[str, Any]]:
                 mode = "bottom"
             case 5:
                 mode = "top"
-        parsed_data.setdefault("position", mode)
-        # parsed_data["border"] = False
-        barrage_list.append(parsed_data)
+        barrage_list.append(
+            float(elem.progress / 1000),
+            elem.content,
+            int_to_hex_color(int(elem.color)),
+            mode,
+            f"{elem.fontsize}px",
+        )
     return barrage_list
 
 
@@ -191,28 +258,71 @@ def decompress_data(content):
 
 async def fetch_single_barrage(
     url: str, client: requests.AsyncSession
-) -> List[dict[str, Any]]:
+) -> DanmuColumns:
     res = await client.get(url, impersonate="chrome110")
+    if is_signature_failure(res):
+        # 通常是 WBI 密钥已经轮换，刷新密钥后重新签名再试一次
+        wbi_keys.invalidate()
+        query = resolve_url_query(url)
+        url = build_segment_url(
+            query["oid"][0], query["segment_index"][0], await wbi_keys.get()
+        )
+        res = await client.get(url, impersonate="chrome110")
     return parse_data(decompress_data(res.content))
 
 
+async def read_segments(
+    urls: List[str], client: requests.AsyncSession = None, probing: bool = False
+) -> List[DanmuColumns]:
+    # 签名参数 wts/w_rid 每次都会变化，缓存键只使用 oid 和分段序号
+    keys = []
+    for url in urls:
+        query = resolve_url_query(url)
+        keys.append(f"{query['oid'][0]}_{query['segment_index'][0]}")
+    return await fetch_segments(
+        "bilibili",
+        keys,
+        lambda i: fetch_single_barrage(urls[i], client=client),
+        # 第一个分段的 key，探测的每一批共用同一个剧集标记
+        episode=f"{keys[0].split('_', 1)[0]}_1",
+        probing=probing,
+    )
+
+
 async def read_barrage(
     urls: List[str], client: requests.AsyncSession = None
-) -> List[dict[str, Any]]:
-    tasks = [fetch_single_barrage(url, client=client) for url in urls]
-    results = await asyncio.gather(*tasks)
-    barrage_list = []
-    for result in results:
-        barrage_list.extend(result)
+) -> DanmuColumns:
+    return DanmuColumns.concat(await read_segments(urls, client=client))
+
+
+async def probe_barrage(cid: Any, client: requests.AsyncSession = None) -> DanmuColumns:
+    """没有时长信息时按批探测分段，连续出现空分段后停止"""
+    barrage_list = DanmuColumns()
+    empty = 0
+    for first in range(1, MAX_SEGMENTS + 1, PROBE_BATCH):
+        last = min(first + PROBE_BATCH - 1, MAX_SEGMENTS)
+        urls = await get_link(cid, first, last)
+        for result in await read_segments(urls, client=client, probing=True):
+            barrage_list.extend(result)
+            empty = 0 if result else empty + 1
+        if empty >= EMPTY_SEGMENTS_STOP:
+            break
     return barrage_list
 
 
-async def get_bilibili_danmu(url: str) -> List[Dict[str, Any]]:
-    danmu_list = []
+async def get_bilibili_danmu(url: str) -> DanmuColumns:
+    danmu_list = DanmuColumns()
     if "bilibili.com" in url:
-        async with requests.AsyncSession() as client:
-            urls = await get_link(url, client=client)
-            danmu_list = await read_barrage(urls, client=client)
+        async with session_pool.borrow("bilibili") as client:
+            episode = await get_episode(url, client=client)
+            if not episode:
+                return danmu_list
+            segment_count = plan_segments(episode.get("duration"))
+            if segment_count is None:
+                danmu_list = await probe_barrage(episode.get("cid"), client=client)
+            else:
+                urls = await get_link(episode.get("cid"), 1, segment_count)
+                danmu_list = await read_barrage(urls, client=client)
     return danmu_list
 
 
@@ -220,7 +330,7 @@ async def get_bilibili_episode_url(url: str) -> Dict[str, str]:
     url_dict = {}
     if "bilibili.com" in url:
         api_epid_cid = "https://api.bilibili.com/pgc/view/web/season"
-        async with requests.AsyncSession() as client:
+        async with session_pool.borrow("bilibili") as client:
             if url.find("bangumi/") != -1 and url.find("ep") != -1:
                 epid_matches = re.findall(r"ep(\d+)", url)
                 if not epid_matches:
@@ -237,6 +347,16 @@ async def get_bilibili_episode_url(url: str) -> Dict[str, str]:
     return url_dict
 
 
+register_provider(
+    Provider(
+        name="bilibili",
+        hosts=("bilibili.com",),
+        resolve_episodes=get_bilibili_episode_url,
+        fetch_danmu=get_bilibili_danmu,
+    )
+)
+
+
 if __name__ == "__main__":
     url = "https://www.bilibili.com/bangumi/play/ep1231553?spm_id_from=333.337.0.0&from_spmid=666.25.episode.0"
     # asyncio.run(get_bilibili_danmu(url))
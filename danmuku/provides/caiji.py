@@ -1,4 +1,5 @@
 from curl_cffi import requests
+from .session import session_pool
 from typing import Optional
 import re
 
@@ -105,7 +106,7 @@ async def get_vod_urls_direct(
 
 async def get_vod_links_from_name(vod_name: str) -> Optional[dict[str, dict[int, str]]]:
     vod_links = {}
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("caiji") as client:
         vod_links = await get_vod_urls_direct(vod_name, client)
         if vod_links:
             return vod_links
@@ -114,7 +115,7 @@ async def get_vod_links_from_name(vod_name: str) -> Optional[dict[str, dict[int,
 
 async def get_vod_links_from_id(vod_id: int) -> Optional[dict[str, dict[int, str]]]:
     vod_links = {}
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("caiji") as client:
         vod_links = await get_vod_urls(vod_id, client)
         if vod_links:
             return vod_links
@@ -127,7 +128,7 @@ async def search_vod_names(vod_name: str) -> Optional[list[str]]:
         "wd": vod_name,
     }
     media_info_list = []
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("caiji") as client:
         res = await client.get(API_URL, params=params, impersonate="chrome124")
         if res.status_code != 200 or not res.json()["list"]:
             return None
@@ -152,7 +153,7 @@ async def get_vod_details(vod_id: int) -> Optional[dict[str, str]]:
     }
     vod_details = {}
     vod_links = {}
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("caiji") as client:
         res = await client.get(API_URL, params=params, impersonate="chrome124")
         if res.status_code != 200 or not res.json()["list"]:
             return None
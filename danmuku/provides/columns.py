@@ -0,0 +1,214 @@
+import re
+import threading
+from array import array
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Sequence, Tuple
+
+
+### 每个编码表最多保存的取值数，编码表在进程内全局共享且不会缩小，需要有上限；
+### 位置列使用 array('B')，也不能超过 256
+INTERN_MAX_SIZE = 256
+### #RRGGBB 形式的颜色直接把 RGB 值写进编码，用最高位与编码表中的下标区分，
+### 第 24 位表示十六进制字母是小写
+PACKED_COLOR = 1 << 31
+LOWER_COLOR = 1 << 24
+_HEX_COLOR = re.compile(r"#(?:[0-9A-F]{6}|[0-9a-f]{6})")
+
+
+class InternTable:
+    """把重复出现的取值（位置、颜色、字号）编码为整数
+
+    第一个初始取值是默认值。编码表满了以后新的取值按默认值编码，
+    正常数据中位置和字号只有少数几种，不会用到这个退路。
+    """
+
+    def __init__(
+        self, initial: Sequence[Hashable] = (), maxsize: int = INTERN_MAX_SIZE
+    ):
+        self.values: List[Hashable] = []
+        self.maxsize = maxsize
+        self.default = 0
+        self._codes: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        for value in initial:
+            self.code(value)
+        if initial:
+            self.default = self.code(initial[0])
+
+    def code(self, value: Hashable) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            # 解析可能在线程池中进行，新增取值时需要加锁
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    if len(self.values) >= self.maxsize:
+                        return self.default
+                    code = len(self.values)
+                    self.values.append(value)
+                    self._codes[value] = code
+        return code
+
+    def value(self, code: int) -> Hashable:
+        return self.values[code]
+
+
+class ColorTable(InternTable):
+    """颜色的编码
+
+    B 站和优酷的颜色可以是任意 24 位 RGB 值，全部放进编码表会让它一直增长。
+    #RRGGBB 形式（字母全大写或全小写）的颜色直接把 RGB 值和大小写写进编码，
+    可以原样还原，不占用编码表；只有其他写法的颜色才放进编码表。
+    """
+
+    def code(self, value: Hashable) -> int:
+        code = self._codes.get(value)
+        if code is not None:
+            return code
+        if isinstance(value, str) and _HEX_COLOR.fullmatch(value):
+            lower = LOWER_COLOR if value.islower() else 0
+            return PACKED_COLOR | lower | int(value[1:], 16)
+        return super().code(value)
+
+    def value(self, code: int) -> Hashable:
+        if code & PACKED_COLOR:
+            if code & LOWER_COLOR:
+                return f"#{code & 0xFFFFFF:06x}"
+            return f"#{code & 0xFFFFFF:06X}"
+        return self.values[code]
+
+
+POSITIONS = InternTable(["right", "top", "bottom"])
+COLORS = ColorTable(["#FFFFFF"])
+SIZES = InternTable(["25px"])
+
+_RIGHT = POSITIONS.code("right")
+_WHITE = COLORS.code("#FFFFFF")
+_SIZE_25 = SIZES.code("25px")
+
+
+def _encode_column(codes: Sequence[int], table: InternTable) -> List[list]:
+    """把全局编码转换为只包含本列取值的局部表，便于跨进程和写入缓存"""
+    local: Dict[int, int] = {}
+    values = []
+    out = []
+    for code in codes:
+        index = local.get(code)
+        if index is None:
+            index = local[code] = len(values)
+            values.append(table.value(code))
+        out.append(index)
+    return [values, out]
+
+
+def _decode_column(column: List[list], table: InternTable, typecode: str) -> array:
+    values, codes = column
+    mapping = [table.code(value) for value in values]
+    return array(typecode, [mapping[index] for index in codes])
+
+
+class DanmuColumns:
+    """按列存储的弹幕集合
+
+    时间保存在 ``array('d')`` 中，位置、颜色和字号保存为全局编码表中的整数，
+    文本单独保存为列表。相比每条弹幕一个字典或列表，内存占用小得多，
+    providers 解析时直接 ``append``，归并、去重和序列化都在列上完成。
+    """
+
+    __slots__ = ("times", "positions", "colors", "sizes", "texts")
+
+    def __init__(self) -> None:
+        self.times = array("d")
+        self.positions = array("B")
+        self.colors = array("I")
+        self.sizes = array("I")
+        self.texts: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __reduce__(self) -> Tuple[Any, Tuple[Dict[str, Any]]]:
+        # 全局编码只在当前进程内有效，序列化时转换为可移植的结构
+        return (DanmuColumns.from_payload, (self.to_payload(),))
+
+    def append(
+        self,
+        time: float,
+        text: str,
+        color: str = "#FFFFFF",
+        position: Any = "right",
+        size: str = "25px",
+    ) -> None:
+        self.times.append(time)
+        self.texts.append(text)
+        self.colors.append(_WHITE if color == "#FFFFFF" else COLORS.code(color))
+        self.positions.append(
+            _RIGHT if position == "right" else POSITIONS.code(position)
+        )
+        self.sizes.append(_SIZE_25 if size == "25px" else SIZES.code(size))
+
+    def extend(self, other: "DanmuColumns") -> None:
+        self.times.extend(other.times)
+        self.positions.extend(other.positions)
+        self.colors.extend(other.colors)
+        self.sizes.extend(other.sizes)
+        self.texts.extend(other.texts)
+
+    @classmethod
+    def concat(cls, parts: Iterable["DanmuColumns"]) -> "DanmuColumns":
+        danmu = cls()
+        for part in parts:
+            danmu.extend(part)
+        return danmu
+
+    def take(self, indices: Sequence[int]) -> "DanmuColumns":
+        """按下标取出子集，顺序与 indices 一致"""
+        danmu = DanmuColumns()
+        times, positions, colors, sizes, texts = (
+            self.times,
+            self.positions,
+            self.colors,
+            self.sizes,
+            self.texts,
+        )
+        danmu.times = array("d", [times[i] for i in indices])
+        danmu.positions = array("B", [positions[i] for i in indices])
+        danmu.colors = array("I", [colors[i] for i in indices])
+        danmu.sizes = array("I", [sizes[i] for i in indices])
+        danmu.texts = [texts[i] for i in indices]
+        return danmu
+
+    def rows(self) -> Iterator[Tuple[Any, ...]]:
+        """逐条产出 (time, position, color, size, text)"""
+        positions = POSITIONS.values
+        # 颜色编码需要解码，每种编码只解码一次
+        colors = {code: COLORS.value(code) for code in set(self.colors)}
+        sizes = SIZES.values
+        return zip(
+            self.times,
+            [positions[code] for code in self.positions],
+            [colors[code] for code in self.colors],
+            [sizes[code] for code in self.sizes],
+            self.texts,
+        )
+
+    def to_list(self) -> List[List[Any]]:
+        return [list(row) for row in self.rows()]
+
+    def to_payload(self) -> Dict[str, Any]:
+        return {
+            "time": self.times.tolist(),
+            "position": _encode_column(self.positions, POSITIONS),
+            "color": _encode_column(self.colors, COLORS),
+            "size": _encode_column(self.sizes, SIZES),
+            "text": self.texts,
+        }
+
+    @classmethod
+    def from_payload(cls, payload: Dict[str, Any]) -> "DanmuColumns":
+        danmu = cls()
+        danmu.times = array("d", payload["time"])
+        danmu.positions = _decode_column(payload["position"], POSITIONS, "B")
+        danmu.colors = _decode_column(payload["color"], COLORS, "I")
+        danmu.sizes = _decode_column(payload["size"], SIZES, "I")
+        danmu.texts = list(payload["text"])
+        return danmu
@@ -1,5 +1,5 @@
 import re
-from curl_cffi import requests
+from .session import session_pool
 from urllib import parse
 import cn2an
 from typing import Optional
@@ -7,7 +7,7 @@ import datetime
 
 
 async def get_platform_link(douban_id: str) -> dict[str, list[str]]:
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("douban") as client:
         res = await client.get(
             f"https://movie.douban.com/subject/{douban_id}/",
             headers={
@@ -56,7 +56,7 @@ async def douban_select(name: str, tv_num: Optional[str] = None) -> Optional[dic
         "referer": "https://servicewechat.com/wx2f9b06c1de1ccfca/99/page-frame.html",
         "accept-language": "zh-CN,zh;q=0.9",
     }
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("douban") as client:
         res = await client.get(url, params=params, headers=headers)
         json_data = res.json().get("items", [])
         for i in json_data:
@@ -101,7 +101,7 @@ async def douban_get_first_url(target_id: str) -> list[str]:
         "referer": "https://servicewechat.com/wx2f9b06c1de1ccfca/99/page-frame.html",
         "accept-language": "zh-CN,zh;q=0.9",
     }
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("douban") as client:
         res = await client.get(url, headers=headers)
     json_data = res.json().get("vendors", [])
     url_list = []
@@ -126,7 +126,7 @@ async def select_by_360(
             # 如果转换失败，保持原样
             pass
     url = f"https://api.so.360kan.com/index?kw={name}&from&pageno=1&v_ap=1&tab=all"
-    async with requests.AsyncSession() as session:
+    async with session_pool.borrow("360kan") as session:
         res = await session.get(url, impersonate="chrome124")
         json_data = res.json()
         for item in json_data.get("data", {}).get("longData", {}).get("rows", []):
@@ -176,7 +176,7 @@ def get_latest_douban_hotlist_url():
 
 async def douban_get_recommend_data() -> dict:
     latest_url, yesterday_url = get_latest_douban_hotlist_url()
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("github") as client:
         res = await client.get(latest_url)
         if res.status_code == 200:
             return res.json()
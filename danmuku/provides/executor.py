@@ -0,0 +1,119 @@
+import asyncio
+import contextlib
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+### 解压和解析弹幕分段的方式：thread（线程池）、process（进程池）或 inline（直接在事件循环中执行）
+DECODE_EXECUTOR = os.getenv("DANMU_DECODE_EXECUTOR", "thread")
+### 线程池或进程池的工作者数量
+DECODE_WORKERS = int(
+    os.getenv("DANMU_DECODE_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+### 每次交给工作者的分段数，减少进程池的往返和序列化次数
+DECODE_BATCH_SIZE = int(os.getenv("DANMU_DECODE_BATCH_SIZE", "8"))
+
+
+def decode_batch(
+    func: Callable[[bytes], Any], items: List[bytes]
+) -> List[Tuple[bool, Any]]:
+    """在工作者中逐个解码，单个分段出错不影响同一批的其他分段"""
+    results = []
+    for data in items:
+        try:
+            results.append((True, func(data)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class DecodePool:
+    """把 CPU 密集的解压和解析交给线程池或进程池
+
+    同一轮事件循环中到达的原始数据按解码函数攒成一批再提交，
+    ``func`` 必须是模块级函数，返回值需要可以 pickle（进程池模式）。
+    """
+
+    def __init__(
+        self,
+        kind: str = DECODE_EXECUTOR,
+        workers: int = DECODE_WORKERS,
+        batch_size: int = DECODE_BATCH_SIZE,
+    ):
+        self.kind = kind
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self._executor: Optional[Executor] = None
+        self._pending: Dict[
+            Callable[[bytes], Any], List[Tuple[bytes, asyncio.Future]]
+        ] = {}
+
+    def _get_executor(self) -> Optional[Executor]:
+        if self.kind == "inline":
+            return None
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="danmu-decode"
+                )
+        return self._executor
+
+    async def decode(self, func: Callable[[bytes], Any], data: bytes) -> Any:
+        executor = self._get_executor()
+        if executor is None:
+            return func(data)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(func, [])
+        pending.append((data, future))
+        if len(pending) >= self.batch_size:
+            self._flush(func)
+        elif len(pending) == 1:
+            # 等本轮循环中其他已经下载完成的分段一起提交
+            loop.call_soon(self._flush, func)
+        return await future
+
+    def _flush(self, func: Callable[[bytes], Any]) -> None:
+        items = self._pending.pop(func, None)
+        if items:
+            asyncio.get_running_loop().create_task(self._run(func, items))
+
+    async def _run(
+        self, func: Callable[[bytes], Any], items: List[Tuple[bytes, asyncio.Future]]
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self._get_executor(), decode_batch, func, [data for data, _ in items]
+            )
+        except Exception as e:
+            # 进程池崩溃等情况下整批失败，下次使用时重新创建
+            if self.kind == "process":
+                self.shutdown()
+            results = [(False, e)] * len(items)
+        for (_, future), (ok, value) in zip(items, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def shutdown(self) -> None:
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+decode_pool = DecodePool()
+
+
+@contextlib.asynccontextmanager
+async def decode_pool_lifespan() -> AsyncIterator[None]:
+    """应用退出时关闭解码用的线程池或进程池"""
+    try:
+        yield
+    finally:
+        decode_pool.shutdown()
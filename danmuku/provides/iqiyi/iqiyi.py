@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Dict, Iterator, List
 from curl_cffi import requests
 import re
 import hashlib
@@ -6,12 +6,23 @@ import brotlicffi as brotli
 
 # import .iqiyidm_pb2 as Iqiyidm_pb2
 from . import iqiyidm_pb2 as Iqiyidm_pb2
+from ..session import session_pool
+from ..executor import decode_pool
+from ...cache import cached, fetch_segments
+from ...singleflight import single_flight
+from ..columns import DanmuColumns
+from ..registry import Provider, register_provider
+from ..utils import resolve_url_query
 
 # import iqiyidm_pb2 as Iqiyidm_pb2
 import asyncio
 import time
 
 base_headers = {"Accept-Encoding": "gzip,deflate,compress"}
+### 视频信息（tvId、时长、分段链接）的缓存时间（秒）
+META_TTL = 6 * 3600
+### 每个 .br 分段覆盖的秒数
+STEP_LENGTH = 60
 
 
 def get_md5(str: str) -> str:
@@ -20,8 +31,21 @@ def get_md5(str: str) -> str:
     return md5.hexdigest()
 
 
-async def get_link(url, client: requests.AsyncSession = None) -> List[str]:
+def build_segment_urls(tv_id: str, video_duration: int) -> List[str]:
     url_list = []
+    max_index = int(video_duration / STEP_LENGTH) + 1
+    for index in range(1, max_index + 1):
+        i = f"{tv_id}_{STEP_LENGTH}_{index}cbzuw1259a"
+        s = get_md5(i)[-8:]
+        o = f"{tv_id}_{STEP_LENGTH}_{index}_{s}.br"
+        url_list.append(
+            f"https://cmts.iqiyi.com/bullet/{tv_id[-4:-2]}/{tv_id[-2:]}/{o}"
+        )
+    return url_list
+
+
+async def fetch_video_meta(url: str, client: requests.AsyncSession) -> Dict[str, Any]:
+    """从播放页和 accelerator.js 中读取 tvId 和时长，并生成全部分段链接"""
     res = await client.get(url, headers=base_headers, impersonate="chrome124")
     js_url = re.findall(
         r'<script src="(.*?)" referrerpolicy="no-referrer-when-downgrade">',
@@ -36,30 +60,36 @@ async def get_link(url, client: requests.AsyncSession = None) -> List[str]:
     )
     tv_id = re.findall('"tvId":([0-9]+)', res.text)[0]
     video_duration = int(re.findall('"videoDuration":([0-9]+)', res.text)[0])
-    step_length = 60
-    max_index = int(video_duration / step_length) + 1
-    for index in range(1, max_index + 1):
-        i = f"{tv_id}_{step_length}_{index}cbzuw1259a"
-        s = get_md5(i)[-8:]
-        o = f"{tv_id}_{step_length}_{index}_{s}.br"
-        url_list.append(
-            f"https://cmts.iqiyi.com/bullet/{tv_id[-4:-2]}/{tv_id[-2:]}/{o}"
-        )
-    return url_list
+    return {
+        "tv_id": tv_id,
+        "duration": video_duration,
+        "urls": build_segment_urls(tv_id, video_duration),
+    }
+
+
+@single_flight("iqiyi_meta")
+@cached("iqiyi_meta", ttl=META_TTL)
+async def get_cached_video_meta(url: str) -> Dict[str, Any]:
+    async with session_pool.borrow("iqiyi") as client:
+        return await fetch_video_meta(url, client)
+
 
+async def get_video_meta(url: str) -> Dict[str, Any]:
+    # 播放页链接上的统计参数不影响视频信息，缓存键只保留路径
+    if "/v_" in url:
+        url = url.split("?", 1)[0]
+    return await get_cached_video_meta(url)
 
-def parse_data(data: list) -> list[dict]:
-    barrage_list = []
+
+async def get_link(url: str) -> List[str]:
+    return (await get_video_meta(url))["urls"]
+
+
+def parse_data(data: list) -> DanmuColumns:
+    barrage_list = DanmuColumns()
     for entry in data:
         for item in entry.bulletInfo:
-            parsed_data = {}
-            parsed_data.setdefault("text", item.content)
-            parsed_data.setdefault("time", float(item.showTime))
-            parsed_data.setdefault("color", f"#{item.a8}")
-            parsed_data.setdefault("size", "25px")
-            parsed_data["position"] = "right"
-            # parsed_data["border"] = False
-            barrage_list.append(parsed_data)
+            barrage_list.append(float(item.showTime), item.content, f"#{item.a8}")
     return barrage_list
 
 
@@ -70,21 +100,31 @@ def decompress_data(content: bytes) -> list:
     return danmu.entry
 
 
-async def fetch_single_barrage(client: requests.AsyncSession, url: str) -> list[dict]:
-    try:
-        res = await client.get(url, headers=base_headers, impersonate="chrome124")
-        return parse_data(decompress_data(res.content))
-    except Exception as e:
-        print(f"获取弹幕失败 {url}: {e}")
-        return []
+def decode_segment(content: bytes) -> DanmuColumns:
+    """解压并解析一个 .br 分段，在解码线程池或进程池中执行"""
+    return parse_data(decompress_data(content))
+
+
+async def fetch_single_barrage(
+    client: requests.AsyncSession, url: str
+) -> DanmuColumns:
+    res = await client.get(url, headers=base_headers, impersonate="chrome124")
+    if res.status_code == 404:
+        # 按时长估算的最后一个分段可能不存在
+        return DanmuColumns()
+    return await decode_pool.decode(decode_segment, res.content)
 
 
 async def read_barrage(
     urls: List[str], client: requests.AsyncSession = None
-) -> List[dict]:
-    barrage_list = []
-    tasks = [fetch_single_barrage(client, url) for url in urls]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+) -> DanmuColumns:
+    barrage_list = DanmuColumns()
+    results = await fetch_segments(
+        "iqiyi",
+        [url.rsplit("/", 1)[-1] for url in urls],
+        lambda i: fetch_single_barrage(client, urls[i]),
+        return_exceptions=True,
+    )
     for result in results:
         if isinstance(result, Exception):
             print(f"任务执行出错: {result}")
@@ -93,55 +133,42 @@ async def read_barrage(
     return barrage_list
 
 
-async def get_iqiyi_danmu(url: str) -> list[dict]:
-    danmu_list = []
+async def get_iqiyi_danmu(url: str) -> DanmuColumns:
+    danmu_list = DanmuColumns()
     if "iqiyi.com" in url:
-        async with requests.AsyncSession() as client:
-            urls = await get_link(url, client=client)
+        async with session_pool.borrow("iqiyi") as client:
+            urls = await get_link(url)
             danmu_list = await read_barrage(urls, client=client)
     return danmu_list
 
 
-async def get_iqiyi_episode_url(url: str) -> dict[str, str]:
-    from lib.utils import resolve_url_query
-    from jsonpath_ng import parse
+def find_by_key(data: Any, key: str, value: Any) -> Iterator[dict]:
+    """递归查找包含 key 且取值为 value 的字典"""
+    if isinstance(data, dict):
+        if data.get(key) == value:
+            yield data
+        for item in data.values():
+            yield from find_by_key(item, key, value)
+    elif isinstance(data, list):
+        for item in data:
+            yield from find_by_key(item, key, value)
 
+
+async def get_iqiyi_episode_url(url: str) -> dict[str, str]:
     if "iqiyi.com" in url:
-        async with requests.AsyncSession() as client:
+        async with session_pool.borrow("iqiyi") as client:
             try:
                 query = resolve_url_query(url)
                 if query.get("tvid"):
                     tv_id = query.get("tvid")[0]
                 else:
-                    res = await client.get(
-                        url, headers=base_headers, impersonate="chrome124"
-                    )
-                    js_url_matches = re.findall(
-                        r'<script src="(.*?)" referrerpolicy="no-referrer-when-downgrade">',
-                        res.text,
-                    )
-                    if not js_url_matches:
-                        return {}
-                    js_url = js_url_matches[0]
-                    res = await client.get(
-                        f"https:{js_url}",
-                        headers={"referer": url},
-                        impersonate="chrome124",
-                    )
-                    tv_id_matches = re.findall('"tvId":([0-9]+)', res.text)
-                    if not tv_id_matches:
-                        return {}
-                    tv_id = tv_id_matches[0]
+                    tv_id = (await get_video_meta(url))["tv_id"]
                 params = f"entity_id={tv_id}&src=pca_tvg&timestamp={int(time.time())}&secret_key=howcuteitis"
                 url = f"https://mesh.if.iqiyi.com/tvg/v2/lw/base_info?{params}&sign={get_md5(params).upper()}"
                 res = await client.get(
                     url, headers={"referer": url}, impersonate="chrome124"
                 )
-                jsonpath_expr = parse("$..bk_title")
-                matches = [match for match in jsonpath_expr.find(res.json())]
-                result_objs = [
-                    match.context.value for match in matches if match.value == "选集"
-                ]
+                result_objs = list(find_by_key(res.json(), "bk_title", "选集"))
                 url_dict = {}
                 for result_obj in result_objs:
                     d = (
@@ -165,6 +192,16 @@ async def get_iqiyi_episode_url(url: str) -> dict[str, str]:
     return {}
 
 
+register_provider(
+    Provider(
+        name="iqiyi",
+        hosts=("iqiyi.com",),
+        resolve_episodes=get_iqiyi_episode_url,
+        fetch_danmu=get_iqiyi_danmu,
+    )
+)
+
+
 if __name__ == "__main__":
     url = "https://www.iqiyi.com/v_26ecr2p42o0.html?vfm=m_331_dbdy&fv=4904d94982104144a1548dd9040df241&amp;subtype=9&amp;type=online-video&amp;link2key=52541a56ed"
     # asyncio.run(get_iqiyi_danmu(url))
@@ -0,0 +1,232 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, Optional
+from urllib.parse import urlparse
+
+from curl_cffi import requests
+
+### 每个主机初始、最小和最大的并发请求数
+HOST_LIMIT_INITIAL = int(os.getenv("DANMU_HOST_LIMIT_INITIAL", "8"))
+HOST_LIMIT_MIN = int(os.getenv("DANMU_HOST_LIMIT_MIN", "2"))
+HOST_LIMIT_MAX = int(os.getenv("DANMU_HOST_LIMIT_MAX", "64"))
+### 响应延迟超过平均延迟的这么多倍时视为突增，连续突增这么多次才视为过载
+LATENCY_SPIKE_FACTOR = 3.0
+LATENCY_SPIKE_STREAK = 3
+### 过载时并发数乘以的系数，以及两次减小之间至少间隔的时间（秒）
+DECREASE_FACTOR = 0.5
+DECREASE_INTERVAL = float(os.getenv("DANMU_HOST_DECREASE_INTERVAL", "1"))
+### 平均延迟的平滑系数，以及开始判断延迟突增前至少需要的样本数
+LATENCY_ALPHA = 0.1
+LATENCY_MIN_SAMPLES = 10
+
+
+def is_overloaded_status(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+class AIMDLimiter:
+    """单个主机的自适应并发限制
+
+    响应正常时并发数每轮增加 1（加性增），遇到 429、5xx、请求异常或连续的延迟突增时
+    减半（乘性减），每 ``DECREASE_INTERVAL`` 秒内最多减一次，避免同一批失败把并发数
+    一路压到底。平均延迟按每个正常返回的响应更新（包括突增的），主机整体变慢后
+    基准随之上升，不会一直被当作过载。
+    """
+
+    def __init__(
+        self,
+        host: str,
+        initial: int = HOST_LIMIT_INITIAL,
+        minimum: int = HOST_LIMIT_MIN,
+        maximum: int = HOST_LIMIT_MAX,
+    ):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.samples = 0
+        self.successes = 0
+        self.overloads = 0
+        self._last_decrease = 0.0
+        self._spikes = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                # 名额在唤醒时就分配给等待者
+                self.in_flight += 1
+                future.set_result(None)
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经分到名额后才被取消，把名额还回去
+                self.release()
+            else:
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove(future)
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def record(self, latency: float, overloaded: bool) -> None:
+        now = time.monotonic()
+        spike = (
+            self.samples >= LATENCY_MIN_SAMPLES
+            and latency > self.latency * LATENCY_SPIKE_FACTOR
+        )
+        if not overloaded:
+            self.samples += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_ALPHA * (latency - self.latency)
+        self._spikes = self._spikes + 1 if spike else 0
+        if overloaded or self._spikes >= LATENCY_SPIKE_STREAK:
+            self.overloads += 1
+            self._spikes = 0
+            if now - self._last_decrease >= DECREASE_INTERVAL:
+                self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+                self._last_decrease = now
+            return
+        if spike:
+            # 单次突增可能只是偶然的慢请求，不减也不加
+            return
+        self.successes += 1
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self._wake()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator["AIMDLimiter"]:
+        await self.acquire()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency else None,
+            "successes": self.successes,
+            "overloads": self.overloads,
+        }
+
+
+class HostLimits:
+    """按主机名共享的限流器，所有 providers 的请求都经过这里"""
+
+    def __init__(self) -> None:
+        self._limiters: Dict[str, AIMDLimiter] = {}
+
+    def get(self, host: str) -> AIMDLimiter:
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            limiter = self._limiters[host] = AIMDLimiter(host)
+        return limiter
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            host: limiter.snapshot()
+            for host, limiter in sorted(self._limiters.items())
+        }
+
+
+host_limits = HostLimits()
+
+
+class SlotWatch:
+    """记录一次抓取第一次取得并发名额的时刻，排队等待的时间不算请求本身的耗时"""
+
+    def __init__(self) -> None:
+        self.limiter: Optional[AIMDLimiter] = None
+        self.started: Optional[float] = None
+        self.acquired = asyncio.Event()
+
+    def queued(self, limiter: AIMDLimiter) -> None:
+        if self.limiter is None:
+            self.limiter = limiter
+
+    def start(self) -> None:
+        if self.started is None:
+            self.started = time.monotonic()
+            self.acquired.set()
+
+    def busy(self) -> bool:
+        """请求的主机是否还有其他请求在排队"""
+        return self.limiter is not None and self.limiter.waiting > 0
+
+
+_watch: contextvars.ContextVar[Optional[SlotWatch]] = contextvars.ContextVar(
+    "slot_watch", default=None
+)
+
+
+@contextlib.contextmanager
+def watch_slots(watch: SlotWatch) -> Iterator[SlotWatch]:
+    """在此范围内（包括其中创建的任务）经过 LimitedSession 的请求都记到 watch 上"""
+    token = _watch.set(watch)
+    try:
+        yield watch
+    finally:
+        _watch.reset(token)
+
+
+class LimitedSession:
+    """包装 ``AsyncSession``，请求前按目标主机取得并发名额，并把结果反馈给限流器"""
+
+    def __init__(self, session: requests.AsyncSession):
+        self._session = session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._session, name)
+
+    async def request(self, method: str, url: str, *args: Any, **kwargs: Any) -> Any:
+        limiter = host_limits.get(urlparse(url).hostname or "")
+        watch = _watch.get()
+        if watch is not None:
+            watch.queued(limiter)
+        async with limiter.slot():
+            if watch is not None:
+                watch.start()
+            start = time.monotonic()
+            try:
+                res = await self._session.request(method, url, *args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                limiter.record(time.monotonic() - start, overloaded=True)
+                raise
+            limiter.record(
+                time.monotonic() - start, is_overloaded_status(res.status_code)
+            )
+            return res
+
+    async def get(self, url: str, *args: Any, **kwargs: Any) -> Any:
+        return await self.request("GET", url, *args, **kwargs)
+
+    async def post(self, url: str, *args: Any, **kwargs: Any) -> Any:
+        return await self.request("POST", url, *args, **kwargs)
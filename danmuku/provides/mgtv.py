@@ -1,6 +1,15 @@
 import asyncio
-from typing import List, Optional
+import math
+from typing import List
 from curl_cffi import requests
+from .session import session_pool
+from ..cache import fetch_segments
+from .columns import DanmuColumns
+from .registry import Provider, register_provider
+
+### 剧集列表每页的集数，以及同时请求的页数
+EPISODE_PAGE_SIZE = 50
+EPISODE_CONCURRENCY = 4
 
 
 def time_to_second(time: list[str]) -> int:
@@ -36,69 +45,92 @@ async def get_link(client: requests.AsyncSession, url: str) -> List[str]:
     ]
 
 
-def parse_data(data: dict) -> list[dict]:
-    barrage_list = []
+def parse_data(data: dict) -> DanmuColumns:
+    barrage_list = DanmuColumns()
     if data.get("data", {}).get("items", []) is None:
-        return []
+        return barrage_list
     for item in data.get("data", {}).get("items", []):
-        parsed_data = {}
-        parsed_data["text"] = item.get("content", "")
-        parsed_data["time"] = item.get("time", 0) / 1000
-        parsed_data["position"] = "right"
-        parsed_data["color"] = "#FFFFFF"
-        parsed_data["size"] = "25px"
-        # parsed_data["border"] = False
-        # parsed_data["style"] = {}
-        barrage_list.append(parsed_data)
+        barrage_list.append(item.get("time", 0) / 1000, item.get("content", ""))
     return barrage_list
 
 
-async def fetch_single_barrage(client: requests.AsyncSession, param: str) -> list[dict]:
+async def fetch_single_barrage(
+    client: requests.AsyncSession, param: str
+) -> DanmuColumns:
     res = await client.get(param)
     return parse_data(res.json())
 
 
-async def read_barrage(client: requests.AsyncSession, params: list[str]) -> list[dict]:
-    tasks = [fetch_single_barrage(client, param) for param in params]
-    results = await asyncio.gather(*tasks)
-    barrage_list = []
+async def read_barrage(
+    client: requests.AsyncSession, params: list[str]
+) -> DanmuColumns:
+    results = await fetch_segments(
+        "mgtv",
+        [param.split("?", 1)[-1] for param in params],
+        lambda i: fetch_single_barrage(client, params[i]),
+    )
+    barrage_list = DanmuColumns()
     for res in results:
         if res:
             barrage_list.extend(res)
     return barrage_list
 
 
-async def get_mgtv_danmu(url: str) -> list[dict]:
-    danmu_list = []
+async def get_mgtv_danmu(url: str) -> DanmuColumns:
+    danmu_list = DanmuColumns()
     if "mgtv.com" in url:
-        async with requests.AsyncSession() as client:
+        async with session_pool.borrow("mgtv") as client:
             urls = await get_link(client, url)
             danmu_list = await read_barrage(client, urls)
     return danmu_list
 
 
-async def get_mgtv_episode_url(
-    url: str, url_dict: Optional[dict] = None, page: int = 1
-) -> dict[str, str]:
-    if "mgtv.com" not in url:
-        if url_dict is None:
-            url_dict = {}
+async def fetch_episode_page(
+    session: requests.AsyncSession, video_id: str, page: int
+) -> dict:
+    _data_url = f"https://pcweb.api.mgtv.com/episode/list?version=5.5.35&video_id={video_id}&page={page}&size={EPISODE_PAGE_SIZE}"
+    res = await session.get(_data_url, impersonate="chrome124")
+    return res.json().get("data", {})
+
+
+async def get_mgtv_episode_url(url: str) -> dict[str, str]:
+    if "mgtv.com" in url:
         video_id = url.split(".")[-2].split("/")[-1]
-        _data_url = f"https://pcweb.api.mgtv.com/episode/list?version=5.5.35&video_id={video_id}&page={page}&size=50"
-        async with requests.AsyncSession() as session:
-            res = await session.get(_data_url, impersonate="chrome124")
-            for item in res.json().get("data", {}).get("list", []):
-                if item.get("t1") not in url_dict.keys():
+        async with session_pool.borrow("mgtv") as session:
+            # 第一页给出总集数，其余分页限制并发后一起获取
+            first = await fetch_episode_page(session, video_id, 1)
+            total = first.get("total", 0) or 0
+            total_page = first.get("total_page") or math.ceil(
+                total / EPISODE_PAGE_SIZE
+            )
+            semaphore = asyncio.Semaphore(EPISODE_CONCURRENCY)
+
+            async def fetch_page(page: int) -> dict:
+                async with semaphore:
+                    return await fetch_episode_page(session, video_id, page)
+
+            pages = [first] + await asyncio.gather(
+                *[fetch_page(page) for page in range(2, total_page + 1)]
+            )
+        url_dict = {}
+        for data in pages:
+            for item in data.get("list") or []:
+                if item.get("t1") not in url_dict:
                     url_dict[item.get("t1")] = "https://www.mgtv.com" + item.get("url")
-            if len(url_dict.keys()) < res.json().get("data", {}).get(
-                "total", len(url_dict.keys())
-            ):
-                page += 1
-                return await get_mgtv_episode_url(url, url_dict, page)
-            return url_dict
+        return url_dict
     return {}
 
 
+register_provider(
+    Provider(
+        name="mgtv",
+        hosts=("mgtv.com",),
+        resolve_episodes=get_mgtv_episode_url,
+        fetch_danmu=get_mgtv_danmu,
+    )
+)
+
+
 if __name__ == "__main__":
     url = (
         "https://www.mgtv.com/b/755976/23118095.html?fpa=1261&fpos=&lastp=ch_tv&cpid=4"
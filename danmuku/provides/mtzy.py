@@ -1,4 +1,4 @@
-from curl_cffi import requests
+from .session import session_pool
 from typing import Optional
 import re
 
@@ -11,7 +11,7 @@ async def search_vod_names(vod_name: str) -> Optional[list[str]]:
         "wd": vod_name,
     }
     media_info_list = []
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("mtzy") as client:
         res = await client.get(API_URL, params=params, impersonate="chrome124")
         if res.status_code != 200 or not res.json()["list"]:
             return None
@@ -52,7 +52,7 @@ async def get_vod_details(vod_id: int) -> Optional[dict[str, str]]:
     }
     vod_details = {}
     vod_links = {}
-    async with requests.AsyncSession() as client:
+    async with session_pool.borrow("mtzy") as client:
         res = await client.get(API_URL, params=params, impersonate="chrome124")
         if res.status_code != 200 or not res.json()["list"]:
             return None
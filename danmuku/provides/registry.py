@@ -0,0 +1,64 @@
+import importlib
+import pkgutil
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from .columns import DanmuColumns
+
+
+@dataclass(frozen=True)
+class Provider:
+    """一个视频平台：负责的域名、获取剧集链接和获取弹幕的方法"""
+
+    name: str
+    hosts: Tuple[str, ...]
+    resolve_episodes: Callable[[str], Awaitable[Dict[str, str]]]
+    fetch_danmu: Callable[[str], Awaitable[DanmuColumns]]
+
+
+_providers: List[Provider] = []
+_by_host: Dict[str, Provider] = {}
+_loaded = False
+
+
+def register_provider(provider: Provider) -> Provider:
+    """注册平台，域名按后缀匹配，例如 iqiyi.com 同时匹配 www.iqiyi.com"""
+    _providers.append(provider)
+    for host in provider.hosts:
+        _by_host[host.lower()] = provider
+    return provider
+
+
+def load_providers() -> None:
+    """第一次查找平台时导入 provides 下的所有模块，平台模块在导入时注册自己，
+    新增平台只需要在 provides 下加一个模块
+
+    不放在 provides/__init__.py 中导入：cache.py 导入 provides.columns 时会先
+    加载各平台模块，而它们又要从 cache 导入。
+    """
+    global _loaded
+    if _loaded:
+        return
+    package = __name__.rpartition(".")[0]
+    for module in pkgutil.iter_modules(importlib.import_module(package).__path__):
+        importlib.import_module(f"{package}.{module.name}")
+    _loaded = True
+
+
+def find_provider(url: str) -> Optional[Provider]:
+    load_providers()
+    hostname = urlparse(url).hostname
+    if not hostname:
+        return None
+    labels = hostname.lower().split(".")
+    for i in range(len(labels) - 1):
+        provider = _by_host.get(".".join(labels[i:]))
+        if provider is not None:
+            return provider
+    return None
+
+
+def get_providers() -> List[Provider]:
+    load_providers()
+    return list(_providers)
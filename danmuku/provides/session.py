@@ -0,0 +1,74 @@
+import asyncio
+import contextlib
+import os
+from typing import AsyncIterator, Dict, Optional, Tuple
+from curl_cffi import requests
+from .limiter import LimitedSession
+
+### 每个会话同时持有的 curl 句柄上限，也就是单个主机组的最大连接数
+MAX_CLIENTS = int(os.getenv("DANMU_SESSION_MAX_CLIENTS", "32"))
+
+
+class SessionPool:
+    """应用级别的长连接会话池
+
+    按 (impersonate, 主机组) 复用 ``AsyncSession``，同一组主机的请求共享
+    keep-alive 连接、DNS 缓存和 TLS 会话，避免每次请求重新握手。
+    """
+
+    def __init__(self, max_clients: int = MAX_CLIENTS):
+        self.max_clients = max_clients
+        self._sessions: Dict[Tuple[str, str], requests.AsyncSession] = {}
+
+    def get(
+        self,
+        group: str,
+        impersonate: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> requests.AsyncSession:
+        key = (impersonate or "", group)
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(key)
+        # 会话绑定在创建它的事件循环上，循环变化后需要重建
+        if session is None or session._closed or session.loop is not loop:
+            session = requests.AsyncSession(
+                loop=loop,
+                max_clients=self.max_clients,
+                impersonate=impersonate,
+                headers=headers,
+            )
+            self._sessions[key] = session
+        return session
+
+    @contextlib.asynccontextmanager
+    async def borrow(
+        self,
+        group: str,
+        impersonate: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> AsyncIterator[LimitedSession]:
+        """借出会话，用完后不关闭，留给后续请求复用；请求经过按主机的并发限制"""
+        yield LimitedSession(
+            self.get(group, impersonate=impersonate, headers=headers)
+        )
+
+    async def close(self) -> None:
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            try:
+                await session.close()
+            except Exception as e:
+                print(f"关闭会话失败: {e}")
+
+
+session_pool = SessionPool()
+
+
+@contextlib.asynccontextmanager
+async def session_pool_lifespan() -> AsyncIterator[None]:
+    """应用退出时关闭会话池中的所有连接"""
+    try:
+        yield
+    finally:
+        await session_pool.close()
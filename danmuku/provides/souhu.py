@@ -1,65 +1,227 @@
 from curl_cffi import requests
+from .session import session_pool
+from ..cache import fetch_segments
+from .columns import DanmuColumns
+from .registry import Provider, register_provider
+from .utils import resolve_url_query
 import asyncio
-from typing import List
+import math
+from typing import Any, Dict, List, Optional
 import re
 import json
 
+API_DANMU = "https://api.danmu.tv.sohu.com/dmh5/dmListAll"
+### 每个请求覆盖的时间窗口（秒），请求失败或结果像被截断时拆成两半，最小到 MIN_WINDOW_SECONDS
+WINDOW_SECONDS = 600
+MIN_WINDOW_SECONDS = 300
+### 窗口中最后一条弹幕离窗口结束超过这么多秒时，认为结果可能被接口截断
+COVERAGE_SLACK = 60
+### 最多请求到的时长（秒）
+MAX_DURATION = 6 * 3600
+### 没有时长信息时每批探测的窗口数，以及连续多少个空窗口后停止
+PROBE_BATCH = 4
+EMPTY_WINDOWS_STOP = 2
 
-async def get_link(client: requests.AsyncSession, url: str) -> List[str]:
+
+def build_window_url(vid: str, aid: str, time_begin: int, time_end: int) -> str:
+    return f"{API_DANMU}?act=dmlist_v2&request_from=h5_js&vid={vid}&aid={aid}&time_begin={time_begin}&time_end={time_end}"
+
+
+def find_duration(text: str) -> Optional[float]:
+    """从播放页的 ``var duration`` 中读取视频时长（秒）
+
+    页面中其他 "duration" 字段可能属于推荐或相关视频，不作为时长使用。
+    """
+    matches = re.findall(r'var\s+duration\s*=\s*[\'"]?([0-9.]+)', text)
+    if not matches:
+        return None
+    try:
+        duration = float(matches[0])
+    except ValueError:
+        return None
+    return duration if duration > 0 else None
+
+
+async def get_playlist_duration(
+    client: requests.AsyncSession, vid: str, aid: str
+) -> Optional[float]:
+    """从剧集列表中读取 vid 对应视频的 playLength"""
+    try:
+        res = await client.get(
+            "https://pl.hd.sohu.com/videolist",
+            params={"playlistid": aid, "vid": vid},
+            impersonate="chrome124",
+        )
+        res.encoding = res.charset_encoding
+        res_data = json.loads(res.text.encode("utf-8"))
+    except Exception as e:
+        print(f"获取搜狐视频时长失败: {e}")
+        return None
+    for item in res_data.get("videos", []):
+        if str(item.get("vid")) == vid and item.get("playLength"):
+            return float(item.get("playLength"))
+    return None
+
+
+async def get_video_info(
+    client: requests.AsyncSession, url: str
+) -> Optional[Dict[str, Any]]:
     res = await client.get(url, impersonate="chrome124")
     vid_matches = re.findall('vid="(.*?)";', res.text)
     if not vid_matches:
-        return []
+        return None
     vid = vid_matches[0]
     aid_matches = re.findall('playlistId="(.*?)";', res.text)
     if not aid_matches:
-        return []
+        return None
     aid = aid_matches[0]
-    base_url = f"https://api.danmu.tv.sohu.com/dmh5/dmListAll?act=dmlist_v2&request_from=h5_js&vid={vid}&aid={aid}&time_begin=%s&time_end=%s"
-    return [base_url % (i * 300, (i + 1) * 300) for i in range(0, 20)]
+    # 剧集列表按 vid 对应，比播放页中的时长可靠，优先使用
+    duration = await get_playlist_duration(client, vid, aid)
+    if duration is None:
+        duration = find_duration(res.text)
+    return {"vid": vid, "aid": aid, "duration": duration}
+
+
+def link_end(duration: float) -> int:
+    return min(math.ceil(duration), MAX_DURATION)
 
 
-def parse(data: dict) -> list[dict]:
-    data_list = []
+def get_link(vid: str, aid: str, duration: float) -> List[str]:
+    """按视频时长切分时间窗口，最后一个窗口到片尾为止"""
+    end_time = link_end(duration)
+    return [
+        build_window_url(vid, aid, begin, min(begin + WINDOW_SECONDS, end_time))
+        for begin in range(0, end_time, WINDOW_SECONDS)
+    ]
+
+
+def parse(data: dict) -> DanmuColumns:
+    data_list = DanmuColumns()
     for d in data.get("info", {}).get("comments", []):
-        parsed_data = {}
-        parsed_data["time"] = d.get("v", 0)
-        parsed_data["text"] = d.get("c", "")
-        parsed_data["position"] = "right"
-        parsed_data["color"] = "#FFFFFF"
-        parsed_data["size"] = "25px"
-        # parsed_data["border"] = False
-        # parsed_data["style"] = {}
-        data_list.append(parsed_data)
+        data_list.append(float(d.get("v", 0)), d.get("c", ""))
     return data_list
 
 
-async def fetch_single_barrage(client: requests.AsyncSession, param: str) -> list[dict]:
+async def fetch_single_barrage(
+    client: requests.AsyncSession, param: str
+) -> DanmuColumns:
     res = await client.get(param, impersonate="chrome124")
     return parse(res.json())
 
 
-async def read_barrage(client: requests.AsyncSession, urls: list[str]) -> list[dict]:
-    tasks = [fetch_single_barrage(client, url) for url in urls]
-    results = await asyncio.gather(*tasks)
-    barrage_list = []
-    for result in results:
-        barrage_list.extend(result)
+def is_truncated(danmu: DanmuColumns, time_end: int) -> bool:
+    """弹幕没有覆盖到窗口的最后 COVERAGE_SLACK 秒，可能是接口只返回了前面一部分"""
+    return bool(danmu) and max(danmu.times) < time_end - COVERAGE_SLACK
+
+
+async def fetch_window(client: requests.AsyncSession, url: str) -> DanmuColumns:
+    """请求失败或结果可能被截断时把窗口拆成两半重新请求，直到最小窗口
+
+    接口对单个窗口返回的条数是否有上限没有文档，这里按覆盖范围判断：
+    弹幕少的窗口被误判时只是多两次请求，拆分后得到的结果不会比原来少。
+    """
+    query = resolve_url_query(url)
+    time_begin = int(query["time_begin"][0])
+    time_end = int(query["time_end"][0])
+    splittable = time_end - time_begin > MIN_WINDOW_SECONDS
+    try:
+        danmu = await fetch_single_barrage(client, url)
+    except Exception:
+        if not splittable:
+            raise
+        danmu = None
+    else:
+        if not splittable or not is_truncated(danmu, time_end):
+            return danmu
+    vid, aid = query["vid"][0], query["aid"][0]
+    middle = time_begin + (time_end - time_begin) // 2
+    try:
+        halves = await asyncio.gather(
+            fetch_window(client, build_window_url(vid, aid, time_begin, middle)),
+            fetch_window(client, build_window_url(vid, aid, middle, time_end)),
+        )
+    except Exception:
+        if danmu is None:
+            raise
+        return danmu
+    return DanmuColumns.concat(halves)
+
+
+async def read_windows(
+    client: requests.AsyncSession, urls: list[str], probing: bool = False
+) -> List[DanmuColumns]:
+    query = resolve_url_query(urls[0])
+    return await fetch_segments(
+        "souhu",
+        [url.split("?", 1)[-1] for url in urls],
+        lambda i: fetch_window(client, urls[i]),
+        # 窗口随时长变化，剧集标记只用 vid 和 aid，按时长读取和探测共用
+        episode=f"vid={query['vid'][0]}&aid={query['aid'][0]}",
+        probing=probing,
+    )
+
+
+async def read_barrage(
+    client: requests.AsyncSession, urls: list[str]
+) -> DanmuColumns:
+    return DanmuColumns.concat(await read_windows(client, urls))
+
+
+async def probe_barrage(
+    client: requests.AsyncSession, vid: str, aid: str, start: int = 0
+) -> DanmuColumns:
+    """没有时长信息时从 start 开始按批探测时间窗口，连续出现空窗口后停止"""
+    barrage_list = DanmuColumns()
+    empty = 0
+    batch_seconds = WINDOW_SECONDS * PROBE_BATCH
+    for begin in range(start, MAX_DURATION, batch_seconds):
+        urls = [
+            build_window_url(vid, aid, window_begin, window_begin + WINDOW_SECONDS)
+            for window_begin in range(begin, begin + batch_seconds, WINDOW_SECONDS)
+        ]
+        for result in await read_windows(client, urls, probing=True):
+            barrage_list.extend(result)
+            empty = 0 if result else empty + 1
+        if empty >= EMPTY_WINDOWS_STOP:
+            break
     return barrage_list
 
 
-async def get_souhu_danmu(url: str) -> list[dict]:
-    danmu_list = []
+async def read_by_info(
+    client: requests.AsyncSession, info: Dict[str, Any]
+) -> DanmuColumns:
+    """有时长时按时长切分窗口，再多请求片尾之后的一个窗口，确认时长没有估短；
+    片尾之后仍有弹幕时从那里继续探测。没有时长时直接探测。"""
+    vid, aid = info["vid"], info["aid"]
+    if not info["duration"]:
+        return await probe_barrage(client, vid, aid)
+    end_time = link_end(info["duration"])
+    urls = get_link(vid, aid, info["duration"])
+    urls.append(build_window_url(vid, aid, end_time, end_time + WINDOW_SECONDS))
+    results = await read_windows(client, urls)
+    danmu_list = DanmuColumns.concat(results)
+    if results[-1] and end_time + WINDOW_SECONDS < MAX_DURATION:
+        print(f"搜狐视频 {vid} 的时长 {info['duration']} 偏短，继续探测片尾之后的弹幕")
+        danmu_list.extend(
+            await probe_barrage(client, vid, aid, end_time + WINDOW_SECONDS)
+        )
+    return danmu_list
+
+
+async def get_souhu_danmu(url: str) -> DanmuColumns:
+    danmu_list = DanmuColumns()
     if "tv.sohu.com" in url:
-        async with requests.AsyncSession() as client:
-            urls = await get_link(client, url)
-            danmu_list = await read_barrage(client, urls)
+        async with session_pool.borrow("souhu") as client:
+            info = await get_video_info(client, url)
+            if not info:
+                return danmu_list
+            danmu_list = await read_by_info(client, info)
     return danmu_list
 
 
 async def get_souhu_episode_url(url: str) -> dict[str, str]:
     if "tv.sohu.com" in url:
-        async with requests.AsyncSession() as client:
+        async with session_pool.borrow("souhu") as client:
             _res = await client.get(url, impersonate="chrome124")
             vid_matches = re.findall('vid="(.*?)";', _res.text)
             if not vid_matches:
@@ -82,6 +244,16 @@ async def get_souhu_episode_url(url: str) -> dict[str, str]:
     return {}
 
 
+register_provider(
+    Provider(
+        name="souhu",
+        hosts=("tv.sohu.com",),
+        resolve_episodes=get_souhu_episode_url,
+        fetch_danmu=get_souhu_danmu,
+    )
+)
+
+
 if __name__ == "__main__":
     url = "https://tv.sohu.com/v/MjAyNDExMDcvbjYyMDAyMTM5Mi5zaHRtbA==.html"
     asyncio.run(get_souhu_danmu(url))
@@ -1,25 +1,57 @@
-from typing import List
+from typing import Dict, List, Tuple
 from curl_cffi import requests
+from .session import session_pool
+from ..cache import cached, danmu_cache, fetch_segments, make_key
+from ..singleflight import flights, single_flight
+from .columns import DanmuColumns
+from .registry import Provider, register_provider
+import functools
+import html
 import re
-import parsel
 from urllib.parse import urljoin
 import asyncio
 import json
 
+### 播放页解析结果（vid、cid）的缓存时间（秒）
+PAGE_TTL = 6 * 3600
+### 剧集列表每页的集数、没有分页信息时每批并发请求的页数和最多请求的页数
+EPISODE_PAGE_SIZE = 100
+EPISODE_PAGE_BATCH = 4
+EPISODE_MAX_PAGES = 40
+### 剧集列表按 cid 缓存的时间（秒），连载中的剧会持续更新
+EPISODE_TTL = 3600
 
-async def get_link(url, client: requests.AsyncSession = None) -> List[str]:
-    api_danmaku_base = "https://dm.video.qq.com/barrage/base/"
-    api_danmaku_segment = "https://dm.video.qq.com/barrage/segment/"
-    res = await client.get(url)
-    sel = parsel.Selector(res.text)
-    title = sel.xpath("//title/text()").get().split("_")[0]
-    vid = re.findall(f'"title":"{title}","vid":"(.*?)"', res.text)
+
+def parse_page(url: str, text: str) -> Dict[str, str]:
+    """从播放页中读取 vid 和 cid，只用正则取 <title>，不构建完整的 DOM"""
+    title_match = re.search(r"<title[^>]*>(.*?)</title>", text, re.S)
+    title = html.unescape(title_match.group(1)).split("_")[0] if title_match else ""
+    vid = re.findall(f'"title":"{re.escape(title)}","vid":"(.*?)"', text)
     if vid:
         vid = vid[-1]
     if not vid:
         vid = re.search(r"/([a-zA-Z0-9]+)\.html", url)
         if vid:
             vid = vid.group(1)
+    if not vid:
+        return {}
+    cid = re.findall('"cid":"(.*?)"', text)
+    return {"vid": vid, "cid": cid[0] if cid else ""}
+
+
+@single_flight("tencent_page")
+@cached("tencent_page", ttl=PAGE_TTL)
+async def get_page_info(url: str) -> Dict[str, str]:
+    """同一个播放页只下载一次，获取弹幕和获取剧集链接共用"""
+    async with session_pool.borrow("tencent") as client:
+        res = await client.get(url)
+        return parse_page(url, res.text)
+
+
+async def get_link(url, client: requests.AsyncSession = None) -> List[str]:
+    api_danmaku_base = "https://dm.video.qq.com/barrage/base/"
+    api_danmaku_segment = "https://dm.video.qq.com/barrage/segment/"
+    vid = (await get_page_info(url)).get("vid")
     if not vid:
         print("parse vid failed, check url")
         return []
@@ -35,119 +67,192 @@ async def get_link(url, client: requests.AsyncSession = None) -> List[str]:
     return links
 
 
-def parse_data(data: dict) -> List[dict]:
-    barrage_list = []
+@functools.lru_cache(maxsize=256)
+def style_color(content_style: str) -> str:
+    """content_style 的取值只有少数几种，解析结果按原字符串缓存"""
+    return f"#{json.loads(content_style).get('color', 'ffffff')}"
+
+
+def parse_data(data: dict) -> DanmuColumns:
+    barrage_list = DanmuColumns()
     for item in data.get("barrage_list", []):
-        parsed_data = {}
-        parsed_data["text"] = item.get("content", "")
-        parsed_data["time"] = float(item.get("time_offset", 0)) / 1000
-        parsed_data["position"] = "right"
-        parsed_data["color"] = "#ffffff"
-        parsed_data["size"] = "25px"
-        # parsed_data["border"] = False
-        # parsed_data["style"] = {}
+        color = "#ffffff"
         if item.get("content_style") != "":
-            content_style = json.loads(item.get("content_style"))
-            parsed_data["color"] = f"#{content_style.get('color', 'ffffff')}"
-        barrage_list.append(parsed_data)
+            color = style_color(item.get("content_style"))
+        barrage_list.append(
+            float(item.get("time_offset", 0)) / 1000, item.get("content", ""), color
+        )
     return barrage_list
 
 
-async def fetch_single_barrage(client: requests.AsyncSession, url: str) -> List[dict]:
-    """异步获取单个URL的弹幕数据"""
-    try:
-        res = await client.get(url)
-        return parse_data(res.json())
-    except Exception as e:
-        print(f"Error fetching {url}: {e}")
-        return []
+async def fetch_single_barrage(
+    client: requests.AsyncSession, url: str
+) -> DanmuColumns:
+    """异步获取单个URL的弹幕数据，失败时由 fetch_segments 重试"""
+    res = await client.get(url)
+    return parse_data(res.json())
 
 
 async def read_barrage(
     urls: List[str], client: requests.AsyncSession = None
-) -> List[dict]:
+) -> DanmuColumns:
     """异步并发获取所有URL的弹幕数据"""
-    barrage_list = []
+    barrage_list = DanmuColumns()
 
-    tasks = [fetch_single_barrage(client, url) for url in urls]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    results = await fetch_segments(
+        "tencent",
+        urls,
+        lambda i: fetch_single_barrage(client, urls[i]),
+        return_exceptions=True,
+    )
     for result in results:
-        if isinstance(result, list):
+        if isinstance(result, DanmuColumns):
             barrage_list.extend(result)
         else:
             print(f"Error in task: {result}")
     return barrage_list
 
 
-async def get_tencent_danmu(url: str) -> list[dict]:
-    danmu_list = []
+async def get_tencent_danmu(url: str) -> DanmuColumns:
+    danmu_list = DanmuColumns()
     if "v.qq.com" in url:
-        async with requests.AsyncSession() as client:
+        async with session_pool.borrow("tencent") as client:
             urls = await get_link(url, client=client)
             danmu_list = await read_barrage(urls, client=client)
     return danmu_list
 
 
-async def get_tencent_episode_url(url: str) -> dict[str, str]:
-    if "v.qq.com" in url:
-        async with requests.AsyncSession() as client:
-            res = await client.get(url)
-            sel = parsel.Selector(res.text)
-            title = sel.xpath("//title/text()").get().split("_")[0]
-            vid = re.findall(f'"title":"{title}","vid":"(.*?)"', res.text)
-            if vid:
-                vid = vid[-1]
-            if not vid:
-                vid = re.search(r"/([a-zA-Z0-9]+)\.html", url)
-                if vid:
-                    vid = vid.group(1)
-            cid = re.findall('"cid":"(.*?)"', res.text)[0]
-            if not vid:
-                print("解析vid失败, 请检查链接是否正确")
-                return {}
-
-            url = "https://pbaccess.video.qq.com/trpc.universal_backend_service.page_server_rpc.PageServer/GetPageData"
-            data = {
-                "page_params": {
-                    "req_from": "web_vsite",
-                    "page_id": "vsite_episode_list",
-                    "page_type": "detail_operation",
-                    "id_type": "1",
-                    "page_size": "",
-                    "cid": cid,
-                    "vid": vid,
-                    "lid": "",
-                    "page_num": "",
-                    "page_context": "episode_begin=1&episode_end=100&episode_step=1&page_num=0&page_size=100",
-                    "detail_page_type": "1",
-                },
-                "has_cache": 1,
-            }
-            res = await client.post(
-                url,
-                json=data,
-                headers={
-                    "referer": "https://v.qq.com/",
-                    "Cookie": "video_platform=2; vversion_name=8.2.95",
-                },
+def episode_page_context(page_num: int) -> str:
+    begin = page_num * EPISODE_PAGE_SIZE + 1
+    end = begin + EPISODE_PAGE_SIZE - 1
+    return f"episode_begin={begin}&episode_end={end}&episode_step=1&page_num={page_num}&page_size={EPISODE_PAGE_SIZE}"
+
+
+def parse_episode_page(res_json: dict) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """返回本页的 (标题, 链接) 以及接口给出的全部分页 page_context"""
+    module_data = (
+        res_json.get("data", {})
+        .get("module_list_datas", [{}])[0]
+        .get("module_datas", [{}])[0]
+    )
+    episodes = []
+    for item in module_data.get("item_data_lists", {}).get("item_datas", []):
+        item_params = item.get("item_params")
+        episodes.append(
+            (
+                f"{item_params.get('title')}",
+                f"https://v.qq.com/x/cover/{item_params.get('cid')}/{item_params.get('vid')}.html",
             )
-            json_data = res.json().get("data", {})
-            data_list = (
-                json_data.get("module_list_datas", [{}])[0]
-                .get("module_datas", [{}])[0]
-                .get("item_data_lists", {})
-                .get("item_datas", [])
+        )
+    page_contexts = []
+    try:
+        tabs = json.loads(module_data.get("module_params", {}).get("tabs") or "[]")
+        page_contexts = [tab["page_context"] for tab in tabs if tab.get("page_context")]
+    except (TypeError, ValueError, KeyError):
+        pass
+    return episodes, page_contexts
+
+
+async def fetch_episode_page(
+    client: requests.AsyncSession, cid: str, vid: str, page_context: str
+) -> Tuple[List[Tuple[str, str]], List[str]]:
+    url = "https://pbaccess.video.qq.com/trpc.universal_backend_service.page_server_rpc.PageServer/GetPageData"
+    data = {
+        "page_params": {
+            "req_from": "web_vsite",
+            "page_id": "vsite_episode_list",
+            "page_type": "detail_operation",
+            "id_type": "1",
+            "page_size": "",
+            "cid": cid,
+            "vid": vid,
+            "lid": "",
+            "page_num": "",
+            "page_context": page_context,
+            "detail_page_type": "1",
+        },
+        "has_cache": 1,
+    }
+    res = await client.post(
+        url,
+        json=data,
+        headers={
+            "referer": "https://v.qq.com/",
+            "Cookie": "video_platform=2; vversion_name=8.2.95",
+        },
+    )
+    return parse_episode_page(res.json())
+
+
+async def fetch_cid_episodes(cid: str, vid: str) -> Dict[str, str]:
+    """先取第一页，再并发获取其余分页，按集数合并"""
+    async with session_pool.borrow("tencent") as client:
+        first_context = episode_page_context(0)
+        episodes, page_contexts = await fetch_episode_page(
+            client, cid, vid, first_context
+        )
+        pages = [episodes]
+        if page_contexts:
+            # 接口给出了分页标签，直接并发获取其余分页
+            rest = [c for c in page_contexts if c != first_context]
+            pages += await asyncio.gather(
+                *[fetch_episode_page(client, cid, vid, c) for c in rest]
             )
-            url_dict = {}
-            for item in data_list:
-                item_params = item.get("item_params")
-                url_dict[f"{item_params.get('title')}"] = (
-                    f"https://v.qq.com/x/cover/{item_params.get('cid')}/{item_params.get('vid')}.html"
+            pages = [pages[0]] + [page for page, _ in pages[1:]]
+        else:
+            # 没有分页标签时按页数逐批并发探测，直到某一页不满
+            page_num = 1
+            while page_num < EPISODE_MAX_PAGES and len(pages[-1]) >= EPISODE_PAGE_SIZE:
+                batch = range(
+                    page_num, min(page_num + EPISODE_PAGE_BATCH, EPISODE_MAX_PAGES)
                 )
-            return url_dict
+                results = await asyncio.gather(
+                    *[
+                        fetch_episode_page(client, cid, vid, episode_page_context(n))
+                        for n in batch
+                    ]
+                )
+                pages += [page for page, _ in results]
+                page_num += len(batch)
+    url_dict = {}
+    for page in pages:
+        for title, episode_url in page:
+            url_dict[title] = episode_url
+    return url_dict
+
+
+async def get_cid_episodes(cid: str, vid: str) -> Dict[str, str]:
+    """剧集列表按 cid 缓存，同一部剧的任意一集都命中同一份缓存"""
+    key = make_key("tencent_episodes", cid)
+    url_dict = await danmu_cache.get(key)
+    if url_dict is None:
+        url_dict = await flights.do(key, lambda: fetch_cid_episodes(cid, vid))
+        if url_dict:
+            await danmu_cache.set(key, url_dict, EPISODE_TTL)
+    return url_dict
+
+
+async def get_tencent_episode_url(url: str) -> dict[str, str]:
+    if "v.qq.com" in url:
+        page = await get_page_info(url)
+        vid, cid = page.get("vid"), page.get("cid")
+        if not vid or not cid:
+            print("解析vid失败, 请检查链接是否正确")
+            return {}
+        return await get_cid_episodes(cid, vid)
     return {}
 
 
+register_provider(
+    Provider(
+        name="tencent",
+        hosts=("v.qq.com",),
+        resolve_episodes=get_tencent_episode_url,
+        fetch_danmu=get_tencent_danmu,
+    )
+)
+
+
 if __name__ == "__main__":
     url = "https://v.qq.com/x/cover/mzc00200iyue5he/k4101w92tew.html"
     asyncio.run(get_tencent_danmu(url))
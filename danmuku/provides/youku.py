@@ -1,22 +1,36 @@
 import re
-from typing import List, Optional
+from typing import Dict, List, Optional
 from curl_cffi import requests
+from .session import session_pool
+from ..cache import fetch_segments
+from .columns import DanmuColumns
+from .registry import Provider, register_provider
 import time
 import base64
 import json
 import hashlib
 import asyncio  # 新增
 
+### _m_h5_tk 中没有过期时间时按此有效期（秒）处理
+TOKEN_TTL = 1800
+### 距离过期不足这么久（秒）时在后台提前刷新
+TOKEN_REFRESH_AHEAD = 300
+### 获取令牌失败后这么久（秒）内不再重新获取，避免每个分段都串行地请求一遍
+TOKEN_RETRY_AFTER = 30
+### 每次请求的分钟数（mcount）
+BATCH_MINUTES = 5
 
-async def get_cna(client: requests.AsyncSession) -> None:
+
+async def get_cna(client: requests.AsyncSession) -> str:
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
     }
     url = "https://log.mmstat.com/eg.js"
-    await client.get(url, headers=headers)
+    res = await client.get(url, headers=headers)
+    return res.cookies.get("cna") or client.cookies.get("cna", "")
 
 
-async def get_tk_enc(client: requests.AsyncSession) -> bool:
+async def get_tk_enc(client: requests.AsyncSession) -> Dict[str, str]:
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
     }
@@ -25,8 +39,102 @@ async def get_tk_enc(client: requests.AsyncSession) -> bool:
         headers=headers,
     )
     if "_m_h5_tk" in res.cookies.keys() and "_m_h5_tk_enc" in res.cookies.keys():
-        return True
-    return False
+        return {
+            "_m_h5_tk": res.cookies.get("_m_h5_tk"),
+            "_m_h5_tk_enc": res.cookies.get("_m_h5_tk_enc"),
+        }
+    return {}
+
+
+def token_expire_at(token: str) -> float:
+    """_m_h5_tk 的格式为 "<token>_<时间戳毫秒>"，时间戳在将来时按它过期，否则使用默认有效期"""
+    expire_at = time.time() + TOKEN_TTL
+    try:
+        stamp = int(token.rsplit("_", 1)[1]) / 1000
+    except (IndexError, ValueError):
+        return expire_at
+    return min(stamp, expire_at) if stamp > time.time() else expire_at
+
+
+class YoukuAuth:
+    """进程内共享的 cna 和 _m_h5_tk，过期前在后台刷新，令牌失效时重新获取"""
+
+    def __init__(self) -> None:
+        self.cna = ""
+        self.tokens: Dict[str, str] = {}
+        self._expire_at = 0.0
+        self._retry_at = 0.0
+        self._lock = asyncio.Lock()
+        self._refreshing: Optional[asyncio.Task] = None
+
+    @property
+    def token(self) -> str:
+        return self.tokens.get("_m_h5_tk", "")
+
+    def cookies(self) -> Dict[str, str]:
+        return {"cna": self.cna, **self.tokens}
+
+    def _valid(self) -> bool:
+        return bool(self.token) and time.time() < self._expire_at
+
+    def _update(self, tokens: Dict[str, str]) -> None:
+        self.tokens = tokens
+        self._expire_at = token_expire_at(tokens["_m_h5_tk"])
+
+    async def _refresh(self) -> None:
+        # 先记下下次允许重试的时间，获取失败或抛出异常时都会生效
+        self._retry_at = time.time() + TOKEN_RETRY_AFTER
+        async with session_pool.borrow(
+            "youku_auth",
+            headers={
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
+            },
+        ) as client:
+            if not self.cna:
+                self.cna = await get_cna(client)
+            tokens = await get_tk_enc(client)
+        if tokens:
+            self._update(tokens)
+            self._retry_at = 0.0
+
+    async def _refresh_in_background(self) -> None:
+        try:
+            async with self._lock:
+                if time.time() >= self._expire_at - TOKEN_REFRESH_AHEAD:
+                    await self._refresh()
+        except Exception as e:
+            print(f"后台刷新优酷token失败: {e}")
+
+    async def get(self) -> Dict[str, str]:
+        if not self._valid():
+            if time.time() < self._retry_at:
+                # 刚刚获取失败，直接返回现有的 cookie，由调用方按失败处理
+                return self.cookies()
+            async with self._lock:
+                # 等锁期间可能已经被其他请求刷新，或者刷新失败
+                if not self._valid() and time.time() >= self._retry_at:
+                    await self._refresh()
+        elif time.time() >= self._expire_at - TOKEN_REFRESH_AHEAD and (
+            self._refreshing is None or self._refreshing.done()
+        ):
+            self._refreshing = asyncio.create_task(self._refresh_in_background())
+        return self.cookies()
+
+    def invalidate(self, token: str, tokens: Optional[Dict[str, str]] = None) -> None:
+        """令牌失效时调用；只有失效的仍是当前令牌时才作废，响应里带回了新令牌就直接使用"""
+        if token != self.token:
+            return
+        if tokens and tokens.get("_m_h5_tk") and tokens["_m_h5_tk"] != token:
+            self._update(tokens)
+        else:
+            self._expire_at = 0.0
+
+
+youku_auth = YoukuAuth()
+
+
+def is_token_expired(data: dict) -> bool:
+    return any("TOKEN" in str(ret) for ret in data.get("ret", []))
 
 
 async def create_client() -> requests.AsyncSession:
@@ -95,126 +203,184 @@ async def get_vid_list(client: requests.AsyncSession, url: str) -> List[dict[str
     return all_params
 
 
-def parse_data(data: dict) -> list[dict]:
-    barrage_list = []
+def parse_data(data: dict) -> DanmuColumns:
+    barrage_list = DanmuColumns()
     result = json.loads(data.get("data", {}).get("result", {}))
     if result.get("code", "-1") == "-1":
-        return []
+        return barrage_list
     danmus = result.get("data", {}).get("result", [])
     for danmu in danmus:
-        parsed_data = {}
-        parsed_data["text"] = danmu.get("content", "")
-        parsed_data["time"] = danmu.get("playat") / 1000
-        parsed_data["position"] = "right"
         tmp_color = json.loads(danmu.get("propertis", "{}")).get("color", "#ffffff")
         tmp_color = (
             str(tmp_color)
             if isinstance(tmp_color, str) and tmp_color.startswith("#")
             else f"#{int(tmp_color):06X}"
         )
-        parsed_data["color"] = tmp_color
-        parsed_data["size"] = "25px"
-        # parsed_data["border"] = False
-        # parsed_data["style"] = {}
-        barrage_list.append(parsed_data)
+        barrage_list.append(
+            danmu.get("playat") / 1000, danmu.get("content", ""), tmp_color
+        )
     return barrage_list
 
 
+async def post_danmu_list(
+    client: requests.AsyncSession, msg: dict, cookies: Dict[str, str]
+) -> requests.Response:
+    url = "https://acs.youku.com/h5/mopen.youku.danmu.list/1.0/"
+    data = json.dumps(msg).replace(" ", "")
+    t = int(time.time() * 1000)
+    params_req = {
+        "jsv": "2.5.6",
+        "appKey": "24679788",
+        "t": t,
+        "sign": yk_t_sign(cookies["_m_h5_tk"][:32], str(t), "24679788", data),
+        "api": "mopen.youku.danmu.list",
+        "v": "1.0",
+        "type": "originaljson",
+        "dataType": "jsonp",
+        "timeout": "20000",
+        "jsonpIncPrefix": "utility",
+    }
+
+    headers = client.headers.copy()
+    headers["Content-Type"] = "application/x-www-form-urlencoded"
+    headers["Referer"] = "https://v.youku.com"
+
+    return await client.post(
+        url,
+        data={"data": data},
+        headers=headers,
+        params=params_req,
+        cookies=cookies,
+    )
+
+
 async def fetch_single_barrage(
     client: requests.AsyncSession, params: dict[str, str]
 ) -> Optional[dict]:
     """获取单个时间段的弹幕"""
     try:
-        video_id = params.get("vid")
-        mat = params.get("mat")
+        cookies = await youku_auth.get()
+        if not cookies.get("_m_h5_tk"):
+            print("无法获取优酷token")
+            return None
 
-        url = "https://acs.youku.com/h5/mopen.youku.danmu.list/1.0/"
         msg = {
             "ctime": int(time.time() * 1000),
             "ctype": 10004,
             "cver": "v1.0",
-            "guid": client.cookies.get("cna", ""),
-            "mat": mat,
-            "mcount": 1,
+            "guid": cookies.get("cna", ""),
+            "mat": params.get("mat"),
+            "mcount": params.get("mcount", 1),
             "pid": 0,
             "sver": "3.1.0",
             "type": 1,
-            "vid": video_id,
+            "vid": params.get("vid"),
         }
 
         msg["msg"] = base64.b64encode(
             json.dumps(msg).replace(" ", "").encode("utf-8")
         ).decode("utf-8")
         msg["sign"] = get_msg_sign(msg["msg"])
-        t = int(time.time() * 1000)
-
-        # 检查token是否存在
-        token = client.cookies.get("_m_h5_tk", "")
-        if not token:
-            print("优酷token不存在, 重新获取")
-            await get_tk_enc(client)
-            token = client.cookies.get("_m_h5_tk", "")
-            if not token:
-                print("无法获取优酷token")
-                return None
-
-        params_req = {
-            "jsv": "2.5.6",
-            "appKey": "24679788",
-            "t": t,
-            "sign": yk_t_sign(
-                token[:32], str(t), "24679788", json.dumps(msg).replace(" ", "")
-            ),
-            "api": "mopen.youku.danmu.list",
-            "v": "1.0",
-            "type": "originaljson",
-            "dataType": "jsonp",
-            "timeout": "20000",
-            "jsonpIncPrefix": "utility",
-        }
 
-        headers = client.headers.copy()
-        headers["Content-Type"] = "application/x-www-form-urlencoded"
-        headers["Referer"] = "https://v.youku.com"
+        res = await post_danmu_list(client, msg, cookies)
+        data = res.json()
+        if is_token_expired(data):
+            # 令牌过期，刷新后重试一次
+            youku_auth.invalidate(
+                cookies["_m_h5_tk"],
+                {k: v for k, v in res.cookies.items() if k.startswith("_m_h5_tk")},
+            )
+            res = await post_danmu_list(client, msg, await youku_auth.get())
+            data = res.json()
+        return data
+    except Exception as e:
+        print(f"获取优酷弹幕分段失败(mat={params.get('mat')}): {e}")
+        return None
+
 
-        res = await client.post(
-            url,
-            data={"data": json.dumps(msg).replace(" ", "")},
-            headers=headers,
-            params=params_req,
+def group_batches(
+    params: List[dict[str, str]], size: int = BATCH_MINUTES
+) -> List[dict[str, str]]:
+    """把逐分钟的参数合并为每次请求 size 分钟"""
+    batches = []
+    for i in range(0, len(params), size):
+        group = params[i : i + size]
+        batches.append(
+            {"vid": group[0].get("vid"), "mat": group[0].get("mat"), "mcount": len(group)}
         )
+    return batches
 
-        if res and hasattr(res, "json"):
-            return res.json()
+
+async def fetch_and_parse(
+    client: requests.AsyncSession, params: dict[str, str]
+) -> Optional[DanmuColumns]:
+    res = await fetch_single_barrage(client, params)
+    if not res:
         return None
+    try:
+        return parse_data(res)
     except Exception as e:
-        print(f"获取优酷弹幕分段失败(mat={params.get('mat')}): {e}")
+        print(f"解析优酷弹幕失败(mat={params.get('mat')}): {e}")
         return None
 
 
+def covers_batch(danmu: Optional[DanmuColumns], batch: dict[str, str]) -> bool:
+    """弹幕覆盖到这批的最后一分钟，才认为接口按 mcount 返回了整批
+
+    接口是否支持 mcount 大于 1、单次响应有没有条数上限都没有文档；忽略 mcount
+    时只会返回第一分钟，被截断时到不了最后一分钟，两种情况都不能当作完整结果。
+    """
+    if not danmu:
+        return False
+    return max(danmu.times) >= (batch["mat"] + batch["mcount"] - 1) * 60
+
+
+async def fetch_batch(
+    client: requests.AsyncSession, batch: dict[str, str]
+) -> Optional[DanmuColumns]:
+    """按批获取弹幕，请求失败或没有覆盖整批时退回逐分钟请求"""
+    danmu = await fetch_and_parse(client, batch)
+    if batch["mcount"] == 1 or covers_batch(danmu, batch):
+        return danmu
+    results = await asyncio.gather(
+        *[
+            fetch_and_parse(client, {"vid": batch["vid"], "mat": batch["mat"] + i})
+            for i in range(batch["mcount"])
+        ]
+    )
+    if all(res is None for res in results):
+        # 逐分钟也全部失败时保留整批请求得到的结果
+        return danmu
+    return DanmuColumns.concat(res for res in results if res)
+
+
 async def read_barrage(
     client: requests.AsyncSession, params: list[dict[str, str]]
-) -> list[dict]:
-    barrage_list = []
+) -> DanmuColumns:
+    barrage_list = DanmuColumns()
+    batches = group_batches(params)
 
     # 并发获取所有分段弹幕
-    tasks = [fetch_single_barrage(client, p) for p in params]
-    results = await asyncio.gather(*tasks)
+    results = await fetch_segments(
+        "youku",
+        [f"{b.get('vid')}_{b.get('mat')}_{b.get('mcount')}" for b in batches],
+        lambda i: fetch_batch(client, batches[i]),
+    )
     for res in results:
         if res:
-            barrage_list.extend(parse_data(res))
+            barrage_list.extend(res)
     return barrage_list
 
 
-async def get_youku_danmu(url: str) -> list[dict]:
-    danmu_list = []
+async def get_youku_danmu(url: str) -> DanmuColumns:
+    danmu_list = DanmuColumns()
     if "youku.com" in url:
-        async with requests.AsyncSession() as client:
-            client.headers = {
+        async with session_pool.borrow(
+            "youku",
+            headers={
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-            }
-            await get_cna(client)
-            await get_tk_enc(client)
+            },
+        ) as client:
             urls = await get_vid_list(client, url)
             danmu_list = await read_barrage(client, urls)
     return danmu_list
@@ -222,7 +388,7 @@ async def get_youku_danmu(url: str) -> list[dict]:
 
 async def get_youku_episode_url(url: str) -> dict[str, str]:
     if "youku.com" in url:
-        async with requests.AsyncSession() as client:
+        async with session_pool.borrow("youku_page") as client:
             res = await client.get(url)
             url_dict = {}
             data = re.search(
@@ -239,6 +405,16 @@ async def get_youku_episode_url(url: str) -> dict[str, str]:
     return {}
 
 
+register_provider(
+    Provider(
+        name="youku",
+        hosts=("youku.com",),
+        resolve_episodes=get_youku_episode_url,
+        fetch_danmu=get_youku_danmu,
+    )
+)
+
+
 if __name__ == "__main__":
     url = "https://v.youku.com/v_show/id_XNjQ4MzU2NDAzMg==.html?refer=esfhz_operation.xuka.xj_00003036_000000_FNZfau_19010900&amp%3Bsubtype=3&amp%3Btype=online-video&amp%3Blink2key=7c84f7aae0&s=bdfb0949ae4c4ac39168"
     danmu = asyncio.run(get_youku_danmu(url))
@@ -0,0 +1,175 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import random
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, Optional
+
+from .deadline import SEGMENT_TIMEOUT
+from .provides.limiter import SlotWatch, watch_slots
+
+### 单个分段失败后最多重试的次数
+SEGMENT_RETRIES = int(os.getenv("DANMU_SEGMENT_RETRIES", "2"))
+### 重试退避的基础时间和上限（秒），实际等待时间在 0 到退避时间之间随机
+RETRY_BACKOFF = 0.2
+RETRY_BACKOFF_MAX = 2.0
+### 分段耗时超过同一来源的 p95 时再发一个相同的请求，先返回的结果胜出
+HEDGE_ENABLED = os.getenv("DANMU_SEGMENT_HEDGE", "1") == "1"
+### 计算 p95 使用的最近样本数、开始对冲前至少需要的样本数和最短等待时间（秒）
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+
+
+@dataclass
+class SegmentStats:
+    """一次请求中分段下载的统计"""
+
+    segments: int = 0
+    cached: int = 0
+    retried: int = 0
+    hedged: int = 0
+    lost: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return asdict(self)
+
+    def header(self) -> str:
+        return ",".join(f"{k}={v}" for k, v in asdict(self).items())
+
+
+_stats: contextvars.ContextVar[Optional[SegmentStats]] = contextvars.ContextVar(
+    "segment_stats", default=None
+)
+
+
+def current_stats() -> SegmentStats:
+    """当前请求的统计；不在请求中时返回一个不会被读取的临时对象"""
+    return _stats.get() or SegmentStats()
+
+
+@contextlib.contextmanager
+def track_segments() -> Iterator[SegmentStats]:
+    """在此范围内（包括其中创建的任务）下载的分段都计入同一个统计"""
+    stats = SegmentStats()
+    token = _stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _stats.reset(token)
+
+
+class LatencyTracker:
+    """按来源记录最近的分段耗时，用于计算对冲的等待时间"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples: Dict[str, Deque[float]] = {}
+        self.window = window
+
+    def record(self, source: str, latency: float) -> None:
+        samples = self._samples.get(source)
+        if samples is None:
+            samples = self._samples[source] = deque(maxlen=self.window)
+        samples.append(latency)
+
+    def p95(self, source: str) -> Optional[float]:
+        samples = self._samples.get(source)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return max(ordered[int(len(ordered) * 0.95) - 1], HEDGE_MIN_DELAY)
+
+
+latencies = LatencyTracker()
+
+
+def backoff(attempt: int) -> float:
+    """指数退避加全随机抖动，避免同一批失败的分段同时重试"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+
+async def timed(
+    source: str, fetch: Callable[[], Awaitable[Any]], watch: SlotWatch
+) -> Any:
+    """执行 fetch，从第一次取得并发名额开始计时，在限流器中排队的时间不计入耗时"""
+    start = time.monotonic()
+    with watch_slots(watch):
+        result = await fetch()
+    if result is not None:
+        latencies.record(source, time.monotonic() - (watch.started or start))
+    return result
+
+
+async def slot_acquired(task: asyncio.Future, watch: SlotWatch) -> None:
+    """等到 task 取得并发名额或者已经结束"""
+    acquired = asyncio.ensure_future(watch.acquired.wait())
+    try:
+        await asyncio.wait({task, acquired}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        acquired.cancel()
+
+
+async def hedged(source: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """取得并发名额后超过 p95 仍未返回时发出第二个请求，取先成功的结果并取消另一个
+
+    主机还有请求在排队时不对冲，多发的请求只会加重排队。取得名额后超过
+    SEGMENT_TIMEOUT 仍未完成时抛出 TimeoutError。
+    """
+    delay = latencies.p95(source) if HEDGE_ENABLED else None
+    watch = SlotWatch()
+    first = asyncio.ensure_future(timed(source, fetch, watch))
+    pending = {first}
+    try:
+        # 在限流器中排队的时间不计入 SEGMENT_TIMEOUT，由平台时间上限和请求的截止时间限制
+        await slot_acquired(first, watch)
+        async with asyncio.timeout(SEGMENT_TIMEOUT):
+            if delay is None:
+                return await first
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done or watch.busy():
+                return await first
+            current_stats().hedged += 1
+            pending.add(asyncio.ensure_future(timed(source, fetch, SlotWatch())))
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif task.result() is not None:
+                        return task.result()
+            if error is not None:
+                raise error
+            return None
+    finally:
+        # 返回、出错或者被取消（例如分段超时）时取消还没完成的请求
+        for task in pending:
+            task.cancel()
+
+
+async def fetch_with_retry(
+    source: str, fetch: Callable[[], Awaitable[Any]]
+) -> Optional[Any]:
+    """下载一个分段：失败（抛出异常、返回 None 或取得并发名额后超过 SEGMENT_TIMEOUT）
+    时退避后重试，全部失败返回 None"""
+    stats = current_stats()
+    for attempt in range(SEGMENT_RETRIES + 1):
+        if attempt:
+            stats.retried += 1
+            await asyncio.sleep(backoff(attempt))
+        try:
+            result = await hedged(source, fetch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"获取 {source} 弹幕分段失败(第 {attempt + 1} 次): {e!r}")
+            continue
+        if result is not None:
+            return result
+    stats.lost += 1
+    return None
@@ -0,0 +1,90 @@
+import asyncio
+import functools
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict
+
+from .cache import make_key
+from .disconnect import ClientState, client_gone, client_scope
+
+
+@dataclass
+class Flight:
+    task: asyncio.Task
+    # 共享任务自己的客户端状态，所有等待者的客户端都断开后才标记为断开
+    client: ClientState
+    waiters: int = 0
+
+
+class SingleFlight:
+    """合并相同的并发请求：同一个 key 同时只执行一次，其余调用等待同一个结果
+
+    最后一个等待者因为客户端断开被取消时，共享的任务也一起取消；等待者只是
+    超时放弃（例如请求时间预算用完）时任务继续执行，结果照常写入缓存。
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[str, Flight] = {}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._calls.get(key)
+        if flight is None:
+            client = ClientState()
+            flight = Flight(asyncio.create_task(self._run(client, func)), client)
+            self._calls[key] = flight
+            flight.task.add_done_callback(lambda done: self._forget(key, done))
+        flight.waiters += 1
+        try:
+            # 某个等待者被取消时不能把共享的任务一起取消
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and client_gone():
+                self._abandon(key, flight)
+            raise
+        finally:
+            flight.waiters -= 1
+
+    @staticmethod
+    async def _run(client: ClientState, func: Callable[[], Awaitable[Any]]) -> Any:
+        with client_scope(client):
+            return await func()
+
+    def _abandon(self, key: str, flight: Flight) -> None:
+        """没有客户端再需要这个结果，取消共享的任务"""
+        if self._calls.get(key) is flight:
+            # 之后的相同调用重新执行，不会等到这个正在取消的任务
+            del self._calls[key]
+        flight.client.gone = True
+        flight.task.cancel()
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        flight = self._calls.get(key)
+        if flight is not None and flight.task is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # 没有等待者时也要取走异常，避免 "exception was never retrieved"
+            task.exception()
+
+
+flights = SingleFlight()
+
+
+def single_flight(
+    namespace: str,
+) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+    """按参数合并并发调用，参数相同的调用共享同一次执行"""
+
+    def decorator(
+        func: Callable[..., Awaitable[Any]],
+    ) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(func)
+        async def wrapper(*args: Any) -> Any:
+            return await flights.do(
+                make_key(f"flight:{namespace}", *args), lambda: func(*args)
+            )
+
+        return wrapper
+
+    return decorator